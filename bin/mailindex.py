@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+##
+# mailindex.py
+###
+"""mailindex.py [maildir]
+
+Counts a Maildir and remembers the headers of its messages, so asking
+again only looks at what has changed since last time.
+"""
+
+__version__ = "0.1"
+__author__ = "Danny O'Brien <http://www.spesh.com/danny/>"
+__copyright__ = "Copyright Danny O'Brien"
+__contributors__ = None
+__license__ = "GPL"
+
+import os
+import sys, getopt
+import time
+import marshal
+import email.parser
+
+summary_headers = ('message-id', 'from', 'subject', 'date', 'x-keywords', 'list-id')
+
+def read_headers(filename):
+    """ The summary headers of a message, reading no further than its
+    first blank line """
+    lines = []
+    with open(filename) as f:
+        for l in f:
+            if not l.strip('\r\n'):
+                break
+            lines.append(l)
+    m = email.parser.HeaderParser().parsestr(''.join(lines), headersonly=True)
+    return dict((h, m[h]) for h in summary_headers)
+
+def unique_name(filename):
+    """ A message's Maildir name without its flags, which can change
+    >>> unique_name('1300000000.M1P2.host:2,S')
+    '1300000000.M1P2.host'
+    """
+    return filename.split(':', 1)[0]
+
+class MaildirIndex:
+    r""" The messages in a Maildir's new and cur, with their summary headers.
+    Each directory is only listed again when its mtime changes, and only
+    messages that weren't there before have their headers read.  The index
+    is kept in .mailindex inside the Maildir.
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> for s in ('new', 'cur', 'tmp'): os.mkdir(os.path.join(d, s))
+    >>> def deliver(name, sender, subject, where='new'):
+    ...     f = open(os.path.join(d, where, name), 'w')
+    ...     f.write('From: %s\nSubject: %s\nMessage-ID: <%s@x>\n\nBody\n' % (sender, subject, name))
+    ...     f.close()
+    >>> deliver('1300000002.M2P1.host', 'b@x', 'Second')
+    >>> deliver('1300000001.M1P1.host:2,S', 'a@x', 'First', 'cur')
+    >>> i = MaildirIndex(d)
+    >>> len(i), i.first()['subject'], i.parsed
+    (2, 'First', 2)
+    >>> os.rename(os.path.join(d, 'new', '1300000002.M2P1.host'), os.path.join(d, 'cur', '1300000002.M2P1.host:2,S'))
+    >>> os.remove(os.path.join(d, 'cur', '1300000001.M1P1.host:2,S'))
+    >>> i.stamps = {} # as if the directories' mtimes had moved on
+    >>> len(i), i.first()['from'], i.parsed
+    (1, 'b@x', 2)
+    >>> j = MaildirIndex(d)
+    >>> len(j), j.first()['message-id'], j.parsed
+    (1, '<1300000002.M2P1.host@x>', 0)
+    >>> shutil.rmtree(d)
+    """
+    subdirs = ('new', 'cur')
+
+    def __init__(self, path, index_filename=None):
+        self.path = os.path.expanduser(path)
+        if index_filename is None:
+            index_filename = os.path.join(self.path, '.mailindex')
+        self.index_filename = index_filename
+        self.stamps = {} # subdir -> mtime when we last listed it
+        self.messages = {} # unique name -> (subdir, filename, headers)
+        self.order = None
+        self.parsed = 0 # how many messages we've read headers from
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_filename, 'rb') as f:
+                (path, headers, stamps, messages) = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        # not some other Maildir's, nor missing headers we keep now
+        if path == self.path and headers == summary_headers:
+            (self.stamps, self.messages) = (stamps, messages)
+
+    def save(self):
+        tmp = '%s.%d' % (self.index_filename, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                marshal.dump((self.path, summary_headers, self.stamps, self.messages), f)
+            os.rename(tmp, self.index_filename)
+        except (IOError, OSError):
+            pass # just slower next time
+
+    def refresh(self):
+        """ Bring the index up to date, returning whether anything changed """
+        stale = {}
+        for subdir in self.subdirs:
+            try:
+                mtime = os.stat(os.path.join(self.path, subdir)).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is None or mtime != self.stamps.get(subdir):
+                if mtime is not None and time.time() - mtime < 2:
+                    # it may change again within the mtime's granularity
+                    mtime = None
+                stale[subdir] = mtime
+        if not stale:
+            return False
+        self.rescan(stale)
+        self.stamps.update(stale)
+        self.order = None
+        self.save()
+        return True
+
+    def rescan(self, subdirs):
+        """ List subdirs together, so a message moving between them is
+        recognised and its headers kept """
+        listing = {}
+        for subdir in subdirs:
+            try:
+                names = os.listdir(os.path.join(self.path, subdir))
+            except OSError:
+                names = []
+            for name in names:
+                if not name.startswith('.'):
+                    listing[unique_name(name)] = (subdir, name)
+        for (u, (subdir, name, headers)) in self.messages.items():
+            if subdir in subdirs and u not in listing:
+                del self.messages[u]
+        for (u, (subdir, name)) in listing.items():
+            old = self.messages.get(u)
+            if old:
+                if old[:2] != (subdir, name):
+                    self.messages[u] = (subdir, name, old[2])
+                continue
+            try:
+                headers = read_headers(os.path.join(self.path, subdir, name))
+            except IOError:
+                continue # gone already
+            self.parsed += 1
+            self.messages[u] = (subdir, name, headers)
+
+    def __len__(self):
+        self.refresh()
+        return len(self.messages)
+
+    def in_order(self):
+        """ (subdir, filename, headers) for each message, earliest delivered first """
+        self.refresh()
+        if self.order is None:
+            self.order = sorted(self.messages)
+        return [self.messages[u] for u in self.order]
+
+    def first(self):
+        """ The summary headers of the earliest delivered message, or None """
+        self.refresh()
+        if self.order is None:
+            self.order = sorted(self.messages)
+        if not self.order:
+            return None
+        return self.messages[self.order[0]][2]
+
+def main(args):
+    """ Print the count and the first message of each Maildir given """
+    for path in args:
+        i = MaildirIndex(path)
+        n = len(i)
+        first = i.first()
+        if first:
+            print "%s: %d, first from %s about %s" % (path, n, first['from'], first['subject'])
+        else:
+            print "%s: %d" % (path, n)
+
+class Main():
+    """ Encapsulates option handling. Subclass to add new options,
+        add 'handle_x' method for an -x option,
+        add 'handle_xlong' method for an --xlong option
+        help (-h, --help) should be automatically created from module
+        docstring and handler docstrings.
+        test (-t, --test) will run all docstring and unittests it finds
+        """
+    class Usage(Exception):
+        def __init__(self, msg):
+            self.msg = msg
+    def __init__(self):
+        handlers  = [i[7:] for i in dir(self) if i.startswith('handle_') ]
+        self.shortopts = ''.join([i for i in handlers if len(i) == 1])
+        self.longopts = [i for i in handlers if (len(i) > 1)]
+    def handler(self,option):
+        i = 'handle_%s' % option.lstrip('-')
+        if hasattr(self, i):
+            return getattr(self, i)
+    def default_main(self, args):
+        print sys.argv[0]," called with ", args
+    def handle_help(self, v):
+        """ Shows this message """
+        print sys.modules.get(__name__).__doc__
+        descriptions = {}
+        for i in list(self.shortopts) + self.longopts:
+            d=self.handler(i).__doc__
+            if d in descriptions:
+                descriptions[d].append(i)
+            else:
+                descriptions[d] = [i]
+        for d, o in descriptions.iteritems():
+            for i in o:
+                if len(i) == 1:
+                    print '-%s' % i,
+                else:
+                    print '--%s' % i,
+            print 
+            print d
+        sys.exit(0)
+    handle_h=handle_help
+
+    def handle_test(self, v):
+        """ Runs test suite for file """
+        import doctest
+        import unittest
+        suite = unittest.defaultTestLoader.loadTestsFromModule(sys.modules.get(__name__))
+        suite.addTest(doctest.DocTestSuite())
+        runner = unittest.TextTestRunner()
+        runner.run(suite)
+        sys.exit(0)
+    handle_t=handle_test
+
+    def run(self, main= None, argv=None):
+        """ Execute main function, having stripped out options and called the
+        responsible handler functions within the class. Main defaults to
+        listing the remaining arguments.
+        """
+        if not callable(main):
+            main = self.default_main
+        if argv is None:
+            argv = sys.argv
+        try:
+            try:
+                opts, args = getopt.getopt(argv[1:], self.shortopts, self.longopts)
+            except getopt.error, msg:
+                raise self.Usage(msg)
+            for o, a in opts:
+                (self.handler(o))(a)
+            return main(args) 
+        except self.Usage, err:
+            print >>sys.stderr, err.msg
+            self.handle_help(None)
+            return 2
+
+if __name__ == "__main__":
+    sys.exit(Main().run(main) or 0)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+##
+# mailquery.py
+###
+"""mailquery.py [maildir] query
+
+Asks a mail store how many messages match a notmuch style query, and
+for the headers of the oldest one.  With no maildir it asks notmuch;
+with one it searches that Maildir itself.
+"""
+
+__version__ = "0.1"
+__author__ = "Danny O'Brien <http://www.spesh.com/danny/>"
+__copyright__ = "Copyright Danny O'Brien"
+__contributors__ = None
+__license__ = "GPL"
+
+import os
+import re
+import time
+import sys, getopt
+import collections
+
+import mailindex
+
+QueryResult = collections.namedtuple('QueryResult', 'count first')
+
+class QueryError(Exception):
+    pass
+
+class NotmuchQuery:
+    """ Queries the notmuch index, through its Python bindings if they're
+    installed and otherwise by running notmuch (without a shell).  Only the
+    count and the oldest message's file are fetched; its headers are read
+    from the file. """
+    def __init__(self, command='notmuch'):
+        self.command = command
+        try:
+            import notmuch
+            self.bindings = notmuch
+        except ImportError:
+            self.bindings = None
+
+    def available(self):
+        """ Whether there's a notmuch to ask """
+        if self.bindings:
+            return True
+        return any(os.access(os.path.join(d, self.command), os.X_OK)
+                   for d in os.environ.get('PATH', '').split(os.pathsep))
+
+    def query(self, q):
+        if self.bindings:
+            (count, filename) = self.query_bindings(q)
+        else:
+            (count, filename) = self.query_command(q)
+        first = None
+        if filename:
+            first = mailindex.read_headers(filename)
+        return QueryResult(count, first)
+
+    def query_bindings(self, q):
+        notmuch = self.bindings
+        db = notmuch.Database(mode=notmuch.Database.MODE.READ_ONLY)
+        try:
+            query = notmuch.Query(db, q)
+            query.set_sort(notmuch.Query.SORT.OLDEST_FIRST)
+            count = query.count_messages()
+            filename = None
+            for m in query.search_messages():
+                filename = m.get_filename()
+                break
+            return (count, filename)
+        finally:
+            db.close()
+
+    def run(self, args):
+        import subprocess
+        try:
+            p = subprocess.Popen([self.command] + args, stdout=subprocess.PIPE)
+        except OSError, e:
+            raise QueryError, "Can't run %s: %s" % (self.command, e)
+        out = p.communicate()[0]
+        if p.returncode:
+            raise QueryError, "%s %s failed" % (self.command, ' '.join(args))
+        return out
+
+    def query_command(self, q):
+        count = int(self.run(['count', '--', q]).strip() or 0)
+        if not count:
+            return (0, None)
+        filenames = self.run(['search', '--output=files', '--sort=oldest-first',
+                              '--limit=1', '--', q]).splitlines()
+        return (count, filenames and filenames[0] or None)
+
+# Maildir flags, as the tags notmuch would give them
+flag_tags = {'F': 'flagged', 'R': 'replied', 'P': 'passed', 'D': 'draft', 'T': 'deleted'}
+
+def delivered(filename):
+    """ When a message was delivered, from the time its Maildir name starts
+    with, or None if it doesn't
+    >>> delivered('1300000000.M1P2.host:2,S'), delivered('odd')
+    (1300000000, None)
+    """
+    try:
+        return int(filename.split('.', 1)[0])
+    except ValueError:
+        return None
+
+def message_tags(subdir, filename, headers, since=None):
+    """ The tags a message in a plain Maildir has: 'inbox', its flags,
+    'unread' unless it's been seen, 'lists' if it has a List-Id, any
+    X-Keywords (which is the only way to get, say, 'archive') and
+    'recently' if it was delivered at or after since, or is still in new
+    when its name doesn't say when it came.
+    >>> sorted(message_tags('cur', '1.M1.h:2,FS', {'x-keywords': 'lists, Work'}))
+    ['flagged', 'inbox', 'lists', 'work']
+    >>> sorted(message_tags('cur', '1300000000.M1.h:2,S', {'list-id': '<l.x>'}, since=1200000000))
+    ['inbox', 'lists', 'recently']
+    >>> sorted(message_tags('new', 'odd', {}, since=1200000000))
+    ['inbox', 'recently', 'unread']
+    """
+    tags = set(['inbox'])
+    if since is not None:
+        when = delivered(filename)
+        if (when is None and subdir == 'new') or (when is not None and when >= since):
+            tags.add('recently')
+    if headers.get('list-id'):
+        tags.add('lists')
+    flags = ''
+    if ':2,' in filename:
+        flags = filename.split(':2,', 1)[1]
+    for f in flags:
+        if f in flag_tags:
+            tags.add(flag_tags[f])
+    if 'S' not in flags:
+        tags.add('unread')
+    keywords = headers.get('x-keywords')
+    if keywords:
+        tags.update(k.strip().lower() for k in keywords.split(',') if k.strip())
+    return tags
+
+query_token_re = re.compile(r'\s*(\(|\)|[^\s()]+)')
+
+def compile_query(q):
+    r""" Turn a query of tag:x terms joined by AND, OR, NOT and brackets
+    into a function of a set of tags.  Terms side by side are ANDed, as in
+    notmuch.
+    >>> f = compile_query('tag:flagged OR (tag:inbox AND tag:recently AND NOT tag:lists)')
+    >>> f(set(['flagged'])), f(set(['inbox', 'recently'])), f(set(['inbox', 'recently', 'lists']))
+    (True, True, False)
+    >>> compile_query('tag:a tag:b')(set(['a']))
+    False
+    >>> compile_query('from:bob')
+    Traceback (most recent call last):
+    QueryError: Only tag: terms are understood, not from:bob
+    """
+    tokens = query_token_re.findall(q)
+    pos = [0]
+    def peek():
+        if pos[0] < len(tokens):
+            return tokens[pos[0]]
+        return None
+    def take():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+    def expression():
+        terms = [conjunction()]
+        while peek() == 'OR':
+            take()
+            terms.append(conjunction())
+        return lambda tags: any(t(tags) for t in terms)
+    def conjunction():
+        factors = [factor()]
+        while peek() not in (None, ')', 'OR'):
+            if peek() == 'AND':
+                take()
+            factors.append(factor())
+        return lambda tags: all(f(tags) for f in factors)
+    def factor():
+        t = peek()
+        if t is None:
+            raise QueryError, "Query ends too soon: %s" % q
+        take()
+        if t == 'NOT':
+            f = factor()
+            return lambda tags: not f(tags)
+        if t == '(':
+            e = expression()
+            if peek() != ')':
+                raise QueryError, "Unbalanced brackets in %s" % q
+            take()
+            return e
+        if not t.startswith('tag:'):
+            raise QueryError, "Only tag: terms are understood, not %s" % t
+        tag = t[4:].lower()
+        return lambda tags: tag in tags
+    e = expression()
+    if peek() is not None:
+        raise QueryError, "Unexpected %s in %s" % (peek(), q)
+    return e
+
+class MaildirQuery:
+    r""" Runs queries against a plain Maildir, with tags from its flags,
+    headers and delivery times (see message_tags), so no mail index is
+    needed.  Messages delivered in the last recent seconds are 'recently'.
+    Headers are kept in a MaildirIndex, so only new mail is read.
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> for s in ('new', 'cur', 'tmp'): os.mkdir(os.path.join(d, s))
+    >>> for (name, subject) in [('1300000001.M1.h:2,S', 'Read'), ('1300000002.M2.h:2,FS', 'Flagged'), ('1300000003.M3.h', 'New')]:
+    ...     file(os.path.join(d, 'cur', name), 'w').write('Subject: %s\n\nBody\n' % subject)
+    >>> m = MaildirQuery(d, os.path.join(d, 'index'))
+    >>> r = m.query('tag:flagged OR tag:unread')
+    >>> r.count, r.first['subject']
+    (2, 'Flagged')
+    >>> m.query('tag:replied')
+    QueryResult(count=0, first=None)
+    >>> m.query('tag:recently').count, m.index.parsed
+    (0, 3)
+    >>> file(os.path.join(d, 'new', '%d.M4.h' % time.time()), 'w').write('Subject: Just in\n\nBody\n')
+    >>> m.index.stamps = {} # as if the directories' mtimes had moved on
+    >>> r = m.query('tag:recently')
+    >>> r.count, r.first['subject'], m.index.parsed
+    (1, 'Just in', 4)
+    >>> shutil.rmtree(d)
+    """
+    recent = 3 * 24 * 3600
+
+    def __init__(self, path, index_filename=None):
+        self.index = mailindex.MaildirIndex(path, index_filename)
+
+    def query(self, q):
+        matches = compile_query(q)
+        count = 0
+        first = None
+        since = time.time() - self.recent
+        for (subdir, name, headers) in self.index.in_order():
+            if matches(message_tags(subdir, name, headers, since)):
+                count += 1
+                if first is None:
+                    first = headers
+        return QueryResult(count, first)
+
+def main(args):
+    """ Print how many messages match, and the oldest one """
+    if not args:
+        raise Main.Usage("Need a query")
+    if len(args) > 1 and os.path.isdir(args[0]):
+        backend = MaildirQuery(args[0])
+        args = args[1:]
+    else:
+        backend = NotmuchQuery()
+    r = backend.query(' '.join(args))
+    print r.count
+    if r.first:
+        print "From %s about %s" % (r.first['from'], r.first['subject'])
+
+class Main():
+    """ Encapsulates option handling. Subclass to add new options,
+        add 'handle_x' method for an -x option,
+        add 'handle_xlong' method for an --xlong option
+        help (-h, --help) should be automatically created from module
+        docstring and handler docstrings.
+        test (-t, --test) will run all docstring and unittests it finds
+        """
+    class Usage(Exception):
+        def __init__(self, msg):
+            self.msg = msg
+    def __init__(self):
+        handlers  = [i[7:] for i in dir(self) if i.startswith('handle_') ]
+        self.shortopts = ''.join([i for i in handlers if len(i) == 1])
+        self.longopts = [i for i in handlers if (len(i) > 1)]
+    def handler(self,option):
+        i = 'handle_%s' % option.lstrip('-')
+        if hasattr(self, i):
+            return getattr(self, i)
+    def default_main(self, args):
+        print sys.argv[0]," called with ", args
+    def handle_help(self, v):
+        """ Shows this message """
+        print sys.modules.get(__name__).__doc__
+        descriptions = {}
+        for i in list(self.shortopts) + self.longopts:
+            d=self.handler(i).__doc__
+            if d in descriptions:
+                descriptions[d].append(i)
+            else:
+                descriptions[d] = [i]
+        for d, o in descriptions.iteritems():
+            for i in o:
+                if len(i) == 1:
+                    print '-%s' % i,
+                else:
+                    print '--%s' % i,
+            print 
+            print d
+        sys.exit(0)
+    handle_h=handle_help
+
+    def handle_test(self, v):
+        """ Runs test suite for file """
+        import doctest
+        import unittest
+        suite = unittest.defaultTestLoader.loadTestsFromModule(sys.modules.get(__name__))
+        suite.addTest(doctest.DocTestSuite())
+        runner = unittest.TextTestRunner()
+        runner.run(suite)
+        sys.exit(0)
+    handle_t=handle_test
+
+    def run(self, main= None, argv=None):
+        """ Execute main function, having stripped out options and called the
+        responsible handler functions within the class. Main defaults to
+        listing the remaining arguments.
+        """
+        if not callable(main):
+            main = self.default_main
+        if argv is None:
+            argv = sys.argv
+        try:
+            try:
+                opts, args = getopt.getopt(argv[1:], self.shortopts, self.longopts)
+            except getopt.error, msg:
+                raise self.Usage(msg)
+            for o, a in opts:
+                (self.handler(o))(a)
+            return main(args) 
+        except self.Usage, err:
+            print >>sys.stderr, err.msg
+            self.handle_help(None)
+            return 2
+
+if __name__ == "__main__":
+    sys.exit(Main().run(main) or 0)
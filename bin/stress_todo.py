@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+##
+# stress_todo.py
+###
+"""stress_todo.py [writers] [edits] [journal]
+
+Runs writers processes at once, each adding edits todos to a scratch
+todo.txt one transaction at a time, then checks that every one of them
+made it into the list.  Pass 'journal' to use TodoListFile's journal mode.
+"""
+
+__version__ = "0.1"
+__author__ = "Danny O'Brien <http://www.spesh.com/danny/>"
+__copyright__ = "Copyright Danny O'Brien"
+__contributors__ = None
+__license__ = "GPL v3 or above"
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import todo
+
+def writer(filename, n, edits, journal):
+    sys.stdout = file(os.devnull, 'w')
+    for i in range(edits):
+        t = todo.TodoListFile(filename, journal=journal)
+        with t.transaction():
+            t.add_new_todo('writer %d edit %d' % (n, i))
+            if i % 5 == 0:
+                t.timestamped_append_to_bottom('writer %d logged %d' % (n, i))
+
+def stress(writers=8, edits=50, journal=False):
+    """ Returns (seconds taken, number of edits lost) """
+    d = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(d, 'todo.txt')
+        print >>file(filename, 'w'), ',INBOX\n\tfirst thing\n,DONE'
+        if journal:
+            todo.TodoListFile(filename, journal=True)
+        procs = [multiprocessing.Process(target=writer, args=(filename, n, edits, journal))
+                 for n in range(writers)]
+        start = time.time()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        taken = time.time() - start
+        contents = set(todo.TodoListFile(filename).contents)
+        lost = 0
+        for n in range(writers):
+            for i in range(edits):
+                if '\twriter %d edit %d' % (n, i) not in contents:
+                    lost += 1
+        return (taken, lost)
+    finally:
+        shutil.rmtree(d)
+
+def main(args):
+    writers = 8
+    edits = 50
+    journal = 'journal' in args
+    args = [i for i in args if i != 'journal']
+    if args:
+        writers = int(args[0])
+    if len(args) > 1:
+        edits = int(args[1])
+    (taken, lost) = stress(writers, edits, journal)
+    print "%d writers x %d edits%s: %.2fs, %.1f transactions/s, %d lost" % (
+        writers, edits, journal and " (journal)" or "", taken,
+        writers * edits / taken, lost)
+    return lost and 1
+
+import getopt
+class Main():
+    """ Encapsulates option handling. Subclass to add new options,
+        add 'handle_x' method for an -x option,
+        add 'handle_xlong' method for an --xlong option
+        help (-h, --help) should be automatically created from module
+        docstring and handler docstrings.
+        test (-t, --test) will run all docstring and unittests it finds
+        """
+    class Usage(Exception):
+        def __init__(self, msg):
+            self.msg = msg
+    def __init__(self):
+        handlers  = [i[7:] for i in dir(self) if i.startswith('handle_') ]
+        self.shortopts = ''.join([i for i in handlers if len(i) == 1])
+        self.longopts = [i for i in handlers if (len(i) > 1)]
+    def handler(self,option):
+        i = 'handle_%s' % option.lstrip('-')
+        if hasattr(self, i):
+           return getattr(self, i)
+    def default_main(self, args):
+        print sys.argv[0]," called with ", args
+    def handle_help(self, v):
+        """ Shows this message """
+        print sys.modules.get(__name__).__doc__
+        descriptions = {}
+        for i in list(self.shortopts) + self.longopts:
+            d=self.handler(i).__doc__
+            if d in descriptions:
+               descriptions[d].append(i)
+            else:
+               descriptions[d] = [i]
+        for d, o in descriptions.iteritems():
+            for i in o:
+                if len(i) == 1:
+                    print '-%s' % i,
+                else:
+                    print '--%s' % i,
+            print 
+            print d
+        sys.exit(0)
+    handle_h=handle_help
+
+    def run(self, main= None, argv=None):
+        """ Execute main function, having stripped out options and called the
+        responsible handler functions within the class. Main defaults to
+        listing the remaining arguments.
+        """
+        if not callable(main):
+            main = self.default_main
+        if argv is None:
+            argv = sys.argv
+        try:
+            try:
+                opts, args = getopt.getopt(argv[1:], self.shortopts, self.longopts)
+            except getopt.error, msg:
+                raise self.Usage(msg)
+            for o, a in opts:
+                (self.handler(o))(a)
+            return main(args) 
+        except self.Usage, err:
+            print >>sys.stderr, err.msg
+            self.handle_help(None)
+            return 2
+
+if __name__ == "__main__":
+    sys.exit(Main().run(main) or 0)
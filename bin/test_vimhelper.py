@@ -19,6 +19,8 @@ import vimhelper
 import os
 import tempfile
 import time
+import subprocess
+import socket
 
 def list_compare(vb, l):
     if len(vb) != len(l):
@@ -62,10 +64,90 @@ class TestVimBuffer(unittest.TestCase):
         v[-1:] = ['last','thing']
         self.assert_(list_compare(v,c))
 
+    def test_snapshot_of_vimbuffer(self):
+        v = vimhelper.VimBuffer("TESTER", self.tempname, snapshot=True)
+        c = ['0','1','2','3','4','5','6']
+        self.assert_(list_compare(v,c))
+        self.assertEquals(v.refresh(), False)
+        v.vimp.setbufline(v.bufnum, 2, 'changed in vim')
+        self.assertEquals(v.refresh(), True)
+        self.assertEquals(v[1], 'changed in vim')
+        v[3:3] = ['goodness','gracious']
+        self.assertEquals(v.refresh(), False)
+        self.assertEquals(v[3:5], ['goodness','gracious'])
+
     def tearDown(self):
         os.system('vim -g --servername TESTER --remote-send \'<Esc>:q!<CR>\'')
         os.unlink(self.tempname)
 
+class TestVimChannel(unittest.TestCase):
+    """ Runs a headless vim that opens a channel straight back to us """
+    def setUp(self):
+        (listener, token) = vimhelper.VimChannel.listen()
+        # someone else on the machine gets in first
+        self.intruder = socket.create_connection(listener.getsockname())
+        self.intruder.sendall('not the token\n')
+        self.vim = subprocess.Popen(['vim', '-N', '-u', 'NONE', '-i', 'NONE', '-n', '-e', '-s',
+            '-c', vimhelper.VimChannel.open_command(listener, token, 'g:c')],
+            stdin=subprocess.PIPE, stdout=file('/dev/null', 'w'))
+        self.vimp = vimhelper.VimProxy('HEADLESS')
+        self.vimp.channel = vimhelper.VimChannel.accept(listener, token)
+
+    def test_only_the_vim_we_asked_gets_in(self):
+        self.assertEquals(self.intruder.recv(10), '')
+
+    def test_expressions_over_channel(self):
+        self.assertEquals(self.vimp.do('1+2'), '3')
+        self.vimp.setline(1, 'hello')
+        self.vimp.append(1, ['a', 'b'])
+        self.assertEquals(self.vimp.getline(1, '$'), 'hello\na\nb')
+        self.assertEquals(self.vimp.do_many(['line("$")', 'getline(2)', 'toupper("x")']),
+                          ['3', 'a', 'X'])
+
+    def test_write_lines_sends_one_change(self):
+        self.vimp.setline(1, ['0', '1', '2', '3'])
+        v = vimhelper.VimBuffer('HEADLESS', '', snapshot=True, proxy=self.vimp)
+        c = ['top', '0', '\tone', '3', 'bottom']
+        v.write_lines(c)
+        self.assertEquals(v.snap, c)
+        self.assertEquals(v.refresh(), False)
+        self.assertEquals(self.vimp.getline(1, '$'), '\n'.join(c))
+        self.vimp.channel.ex('undo')
+        self.assertEquals(self.vimp.getline(1, '$'), '0\n1\n2\n3')
+        self.assertRaises(vimhelper.VimBufferChanged, v.write_lines, ['0'])
+        self.assertEquals(self.vimp.getline(1, '$'), '0\n1\n2\n3')
+
+    def test_slices_agree_with_and_without_snapshot(self):
+        self.vimp.setline(1, ['0', '1', '2', '3'])
+        plain = vimhelper.VimBuffer('HEADLESS', '', proxy=self.vimp)
+        snap = vimhelper.VimBuffer('HEADLESS', '', snapshot=True, proxy=self.vimp)
+        for v in (plain, snap):
+            self.assertEquals(v[1:3], ['1', '2'])
+            self.assertEquals(v[2:], ['2', '3'])
+            self.assertEquals(v[3:1], [])
+            self.assertEquals(list(v), ['0', '1', '2', '3'])
+
+    def test_written_checks_what_vim_has(self):
+        self.vimp.setline(1, ['0', '1', '2', '3'])
+        v = vimhelper.VimBuffer('HEADLESS', '', snapshot=True, proxy=self.vimp)
+        v.take_snapshot()
+        # as if our keys had been autoindented
+        self.vimp.append(1, ['  a', '  b'])
+        v.written(1, 1, ['a', 'b'])
+        self.assertEquals(v.snap, ['0', '  a', '  b', '1', '2', '3'])
+        self.assertEquals(v.refresh(), False)
+        # as if only some of them had got there
+        self.vimp.append(1, ['c'])
+        v.written(1, 1, ['c', 'd'])
+        self.assertEquals(v.snap, None)
+        self.assertEquals(v[:], ['0', 'c', '  a', '  b', '1', '2', '3'])
+
+    def tearDown(self):
+        self.intruder.close()
+        self.vimp.channel.close()
+        self.vim.kill()
+        self.vim.wait()
+
 if __name__ == '__main__':
     import __main__
     try:
@@ -9,12 +9,36 @@ import datetime
 import time
 import random
 import re 
-import subprocess
+import collections
+import contextlib
+import fcntl
+import gzip
+import bisect
+import heapq
+import hashlib
+import json
+import marshal
+import struct
 import sys, getopt
 import os, os.path
 
-import vimhelper
-import dateutil.rrule
+# vimhelper, dateutil, subprocess and numpy are imported where they're used,
+# so commands that don't need them start quicker
+numpy = None # see use_numpy
+numpy_threshold = 2000
+
+def use_numpy(size):
+    """ Whether to rank a list of this many todos with numpy, importing it
+    the first time.  Small lists are quicker without it, import included. """
+    global numpy
+    if size < numpy_threshold:
+        return False
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return bool(numpy)
 
 
 __version__ = "0.2"
@@ -28,6 +52,8 @@ __date__ = "$Date$"
 
 
  
+TagToken = collections.namedtuple('TagToken', 'text name args start end')
+
 def timestamp():
     # there's a race condition here at 23:59:59 on a timezone change day!
     return time.strftime('%Y-%m-%dT%H:%M-%%02d00') % (time.timezone/(3600))
@@ -49,6 +75,9 @@ class Tag(str):
     tag_regexp = r'(\s|\A)(?P<all>(?P<name>[@#$][A-Z_0-9]*)(\((?P<arg>.*?)\))?)'
     tag_regexp_name_group  = 1
     tag_regexp_arg_group = 4
+    tag_re = re.compile(tag_regexp)
+    token_cache = {}
+    token_cache_size = 100000
 
     @staticmethod
     def current_tag():
@@ -70,6 +99,41 @@ class Tag(str):
         return Tag('@REPEAT(%s)' % arg)
     
 
+    @staticmethod
+    def tokenize(s):
+        r""" Scan a string once for tags, returning a tuple of TagTokens.
+        Results are cached by string, so rescanning the same line is free.
+        >>> for t in Tag.tokenize('do it @FOO(1,2) #BAR'): print t
+        TagToken(text='@FOO(1,2)', name='@FOO', args=('1', '2'), start=6, end=15)
+        TagToken(text='#BAR', name='#BAR', args=None, start=16, end=20)
+        """
+        try:
+            return Tag.token_cache[s]
+        except KeyError:
+            pass
+        tokens = []
+        for m in Tag.tag_re.finditer(s):
+            arg = m.group('arg')
+            if arg is not None:
+                arg = tuple(arg.split(','))
+            tokens.append(TagToken(m.group('all'), m.group('name'), arg,
+                                   m.start('all'), m.end('all')))
+        tokens = tuple(tokens)
+        if len(Tag.token_cache) >= Tag.token_cache_size:
+            Tag.token_cache.clear()
+        Tag.token_cache[s] = tokens
+        return tokens
+
+    @staticmethod
+    def from_token(token):
+        """ Build a Tag from a TagToken without rescanning it """
+        t = str.__new__(Tag, token.text)
+        if token.args is None:
+            t.args = None
+        else:
+            t.args = list(token.args)
+        return t
+
     @staticmethod
     def extract_tags(s):
         """ pull out tags from a string 
@@ -79,11 +143,7 @@ class Tag(str):
         >>> m[-1].argument()
         ['12 13']
         """
-        l = []
-        for i in re.finditer(Tag.tag_regexp, s):
-            t = Tag(i.group('all'))
-            l.append(t)
-        return l
+        return [Tag.from_token(t) for t in Tag.tokenize(s)]
 
     def __init__(self,s):
         self.parse_argument()
@@ -102,20 +162,102 @@ class Tag(str):
         >>> print i.ignore_from_repeat(datetime.datetime(year=1990, day=1, month=1))
         @IGNOREUNTIL(1990-01-01T02:00)
         """
-        repeat_args = [ i.split('=') for i in self.argument()[1:]]
-        repeat_dict = dict([ (i, eval(j, {}, {}) ) for (i,j) in repeat_args ])
-        repeat_dict['dtstart'] = now
-        repeat_rule = dateutil.rrule.rrule(eval(self.argument()[0],
-                                                dateutil.rrule.__dict__, {}),
-                                           **repeat_dict)
+        repeat_rule = self.repeat_rule(now)
         return Tag.ignore_tag(repeat_rule.after(now))
      
+    # dateutil.rrule's numbering, so parsing doesn't need to import it
+    repeat_freqs = dict((f, n) for (n, f) in
+                        enumerate(('YEARLY', 'MONTHLY', 'WEEKLY', 'DAILY',
+                                   'HOURLY', 'MINUTELY', 'SECONDLY')))
+    repeat_days = dict((d, n) for (n, d) in
+                       enumerate(('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')))
+    repeat_keys = ('interval', 'count', 'wkst', 'bysetpos', 'bymonth',
+                   'bymonthday', 'byyearday', 'byeaster', 'byweekno',
+                   'byweekday', 'byhour', 'byminute', 'bysecond')
+    repeat_cache = {}
+
+    @staticmethod
+    def parse_repeat(arg):
+        r""" Parse a REPEAT argument like 'WEEKLY,byweekday=MO+TH' into
+        (frequency, rrule keywords). Only frequency names, integers and
+        weekday names are understood; several values are joined with '+'.
+        >>> Tag.parse_repeat('HOURLY,interval=2')
+        (4, {'interval': 2})
+        >>> sorted(Tag.parse_repeat('WEEKLY,byweekday=MO+TH,byhour=9')[1].items())
+        [('byhour', 9), ('byweekday', (0, 3))]
+        >>> Tag.parse_repeat('__import__("os")')
+        Traceback (most recent call last):
+        TodoError: Unknown repeat frequency __import__("os")
+        >>> Tag('@REPEAT').repeat_rule(datetime.datetime(2010, 1, 1))
+        Traceback (most recent call last):
+        TodoError: @REPEAT needs a rule, like @REPEAT(WEEKLY)
+        """
+        if arg is None:
+            raise TodoError, "@REPEAT needs a rule, like @REPEAT(WEEKLY)"
+        try:
+            return Tag.repeat_cache[arg]
+        except KeyError:
+            pass
+        parts = arg.split(',')
+        freq = parts[0].strip()
+        if freq not in Tag.repeat_freqs:
+            raise TodoError, "Unknown repeat frequency %s" % freq
+        kwargs = {}
+        for part in parts[1:]:
+            (key, sep, value) = part.partition('=')
+            key = key.strip()
+            if not sep or key not in Tag.repeat_keys:
+                raise TodoError, "Bad repeat argument %s" % part
+            values = []
+            for v in value.split('+'):
+                v = v.strip()
+                if v in Tag.repeat_days:
+                    values.append(Tag.repeat_days[v])
+                else:
+                    try:
+                        values.append(int(v))
+                    except ValueError:
+                        raise TodoError, "Bad repeat value %s" % part
+            if len(values) == 1:
+                kwargs[key] = values[0]
+            else:
+                kwargs[key] = tuple(values)
+        r = (Tag.repeat_freqs[freq], kwargs)
+        if len(Tag.repeat_cache) >= Tag.token_cache_size:
+            Tag.repeat_cache.clear()
+        Tag.repeat_cache[arg] = r
+        return r
+
+    def repeat_rule(self, dtstart):
+        """ The rrule of a REPEAT tag, starting at dtstart """
+        import dateutil.rrule
+        arg = self.argument()
+        (freq, kwargs) = Tag.parse_repeat(arg and ','.join(arg))
+        return dateutil.rrule.rrule(freq, dtstart=dtstart, **kwargs)
+
+    ignore_time_cache = {}
+
+    def ignore_time(self):
+        r""" The time in an IGNOREUNTIL tag, parsed once per distinct tag
+        >>> print Tag.ignore_tag(datetime.datetime(2005, 5, 5, 12, 10)).ignore_time()
+        2005-05-05 12:10:00
+        """
+        try:
+            return Tag.ignore_time_cache[self]
+        except KeyError:
+            pass
+        t = datetime.datetime.strptime(self.argument()[0], '%Y-%m-%dT%H:%M')
+        if len(Tag.ignore_time_cache) >= Tag.token_cache_size:
+            Tag.ignore_time_cache.clear()
+        Tag.ignore_time_cache[str(self)] = t
+        return t
+
     def parse_argument(self):
         if '(' in self:
-            m = re.match(Tag.tag_regexp, self)
-            if not m:
+            m = Tag.tokenize(self)
+            if not m or m[0].start != 0 or m[0].args is None:
                 return None
-            self.args = m.group('arg').split(',')
+            self.args = list(m[0].args)
             return self.args
 
     def is_project(self):
@@ -183,43 +325,150 @@ class Tag(str):
         >>> print Tag('@BLAH').find_in('por bun wolly @FOO #BAR @BING @BLAH(54 54)')
         (30, 42)
         """
-        m = [i for i in re.finditer(Tag.tag_regexp, s) if i.group('name') == str(self.name()) ]
+        name = self.name()
+        m = [i for i in Tag.tokenize(s) if i.name == name ]
         if len(m) == 0:
             return None
         if len(m) > 1:
             raise TodoError('More than one %s tag in string %s' % (str(self), s))
-        return (m[0].start('all'), m[0].end('all'))
+        return (m[0].start, m[0].end)
+
+class IwgetidWifi:
+    """ Finds the wifi network we're on.  Linux only I'm afraid """
+    def ssid(self):
+        import subprocess
+        try:
+            wifi = subprocess.Popen(['iwgetid','--raw'], stdout=subprocess.PIPE).communicate()[0].strip()
+        except OSError:
+            wifi = None
+        return wifi
+
+class CachedWifi:
+    r""" Keeps another wifi finder's answer in a state file for ttl seconds,
+    so every process started in that time can share it.
+    >>> class FixedWifi:
+    ...     def __init__(self, ssid): (self.fixed, self.calls) = (ssid, 0)
+    ...     def ssid(self): self.calls += 1; return self.fixed
+    >>> import tempfile, os
+    >>> (fd, state) = tempfile.mkstemp()
+    >>> os.unlink(state)
+    >>> w = CachedWifi(FixedWifi('Maze'), state)
+    >>> print w.ssid(), w.ssid(), CachedWifi(FixedWifi('elsewhere'), state).ssid()
+    Maze Maze Maze
+    >>> w.provider.calls
+    1
+    >>> os.unlink(state)
+    """
+    def __init__(self, provider, filename, ttl=300):
+        self.provider = provider
+        self.filename = filename
+        self.ttl = ttl
+
+    def ssid(self):
+        try:
+            if time.time() - os.stat(self.filename).st_mtime < self.ttl:
+                return file(self.filename).read().rstrip('\n') or None
+        except (OSError, IOError):
+            pass
+        ssid = self.provider.ssid()
+        tmp = '%s~%d' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'w')
+            print >>f, ssid or ''
+            f.close()
+            os.rename(tmp, self.filename)
+        except (OSError, IOError):
+            pass
+        return ssid
+
+class TimeRule:
+    """ A context that holds during a range of hours (inclusive, so (8, 12)
+    runs from 8:00 to 12:59) on some days of the week (Monday is 1) """
+    def __init__(self, tag, hours=(0, 23), days=(1, 2, 3, 4, 5, 6, 7)):
+        self.tag = tag
+        self.hours = hours
+        self.days = days
+
+    def holds(self, dow, hour):
+        return dow in self.days and self.hours[0] <= hour <= self.hours[1]
+
+class TimeTable:
+    r""" TimeRules compiled into a table of the hours of the week at which
+    the set of active tags changes.
+    >>> t = TimeTable([TimeRule('@MORNING', hours=(8, 12)), TimeRule('@WEEKEND', days=[6, 7])])
+    >>> sorted(t.active(datetime.datetime(2010, 3, 6, 9, 15)))
+    ['@MORNING', '@WEEKEND']
+    >>> print t.next_change(datetime.datetime(2010, 3, 6, 9, 15))
+    2010-03-06 13:00:00
+    >>> print t.next_change(datetime.datetime(2010, 3, 7, 20, 0))
+    2010-03-08 00:00:00
+    >>> print TimeTable([TimeRule('@DAILY')]).next_change(datetime.datetime(2010, 3, 7, 20, 0))
+    None
+    """
+    week = 7 * 24
+
+    def __init__(self, rules):
+        self.tags = frozenset([r.tag for r in rules])
+        self.starts = []
+        self.active_tags = []
+        for slot in range(TimeTable.week):
+            (dow, hour) = (slot // 24 + 1, slot % 24)
+            tags = frozenset([r.tag for r in rules if r.holds(dow, hour)])
+            if not self.active_tags or tags != self.active_tags[-1]:
+                self.starts.append(slot)
+                self.active_tags.append(tags)
+
+    def slot(self, when):
+        return (when.isoweekday() - 1) * 24 + when.hour
+
+    def interval(self, when):
+        return bisect.bisect_right(self.starts, self.slot(when)) - 1
+
+    def active(self, when):
+        return self.active_tags[self.interval(when)]
+
+    def next_change(self, when):
+        if len(self.starts) == 1:
+            return None
+        i = self.interval(when) + 1
+        if i < len(self.starts):
+            next_slot = self.starts[i]
+        else:
+            next_slot = self.starts[0] + TimeTable.week
+        if next_slot == TimeTable.week and self.active_tags[0] == self.active_tags[-1]:
+            # the last interval carries on into the first one next week
+            next_slot = self.starts[1] + TimeTable.week
+        hours = next_slot - self.slot(when)
+        return when.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=hours)
 
 class ContextHandler():
     work_wifi = ['gnu']         # Yours
     home_wifi = ['spesh.com/wifi', 'Maze']   # will vary
     auto_tags = { '@HOME' : lambda s: s.athome(),
-            '@WORK' : lambda s: s.atwork(),
-            '@MONDAY' : lambda s: (s.dow() == 1 ),
-            '@TUESDAY' : lambda s: (s.dow() == 2 ),
-            '@WEDNESDAY' : lambda s: (s.dow() == 3 ),
-            '@THURSDAY' : lambda s: (s.dow() == 4 ),
-            '@FRIDAY' : lambda s: (s.dow() == 5 ),
-            '@SATURDAY' : lambda s: (s.dow() == 6 ),
-            '@SUNDAY' : lambda s: (s.dow() == 7 ),
-            '@WEEKEND' : lambda s: (s.dow() == 6 or s.dow() == 7),
-            '@MORNING' : lambda s: (s.hour() <= 12 and s.hour() >= 8),
-            '@AFTERNOON' : lambda s: (s.hour() >= 12 and s.hour() <= 17),
-            '@EVENING' : lambda s: (s.hour() >=17 and s.hour() <= 22),
-            '@UKTIME' : lambda s: (s.hour() >= 0 and s.hour() <= 11),
-            '@EASTCOASTTIME' : lambda s: (s.hour() >= 6 and s.hour() <= 15),
-            '@LUNCH' : lambda s: (s.hour() >= 12 and s.hour() <= 13 ),
-            '@WORKDAY' : lambda s: (s.hour() >= 9 and s.hour() <= 18 and s.weekday()), 
-            '@DAILY': lambda s: True,
-            '@URGENT' : lambda s: True }
+            '@WORK' : lambda s: s.atwork() }
+    time_table = TimeTable([ TimeRule('@MONDAY', days=[1]),
+            TimeRule('@TUESDAY', days=[2]),
+            TimeRule('@WEDNESDAY', days=[3]),
+            TimeRule('@THURSDAY', days=[4]),
+            TimeRule('@FRIDAY', days=[5]),
+            TimeRule('@SATURDAY', days=[6]),
+            TimeRule('@SUNDAY', days=[7]),
+            TimeRule('@WEEKEND', days=[6, 7]),
+            TimeRule('@MORNING', hours=(8, 12)),
+            TimeRule('@AFTERNOON', hours=(12, 17)),
+            TimeRule('@EVENING', hours=(17, 22)),
+            TimeRule('@UKTIME', hours=(0, 11)),
+            TimeRule('@EASTCOASTTIME', hours=(6, 15)),
+            TimeRule('@LUNCH', hours=(12, 13)),
+            TimeRule('@WORKDAY', hours=(9, 18), days=[1, 2, 3, 4, 5]),
+            TimeRule('@DAILY'),
+            TimeRule('@URGENT') ])
 
     def wifi(self):
-        # Linux only I'm afraid
-        try:
-            wifi = subprocess.Popen(['iwgetid','--raw'], stdout=subprocess.PIPE).communicate()[0].strip()
-        except OSError:
-            wifi = None
-        return wifi
+        if not self.ssid_known:
+            self.ssid = self.wifi_provider.ssid()
+            self.ssid_known = True
+        return self.ssid
 
     def atwork(self):
         return self.wifi() in ContextHandler.work_wifi
@@ -231,25 +480,57 @@ class ContextHandler():
         return not (self.dow() ==6 or self.dow() == 7)
 
     def dow(self):
-        return datetime.date.today().isoweekday()
+        return self.now.isoweekday()
 
     def hour(self):
-        return datetime.datetime.now().hour
+        return self.now.hour
 
-    def __init__(self, tags):
+    def __init__(self, tags, wifi=None, clock=None):
+        r"""
+        >>> class FixedWifi:
+        ...     def __init__(self, ssid): (self.fixed, self.calls) = (ssid, 0)
+        ...     def ssid(self): self.calls += 1; return self.fixed
+        >>> ch = ContextHandler(['@HOME', '#PYTHON'], wifi=FixedWifi('gnu'),
+        ...     clock=lambda: datetime.datetime(2010, 3, 6, 12, 30))
+        >>> ch.refresh()
+        >>> print sorted(ch.get_tags())
+        ['#PYTHON', '@AFTERNOON', '@DAILY', '@EASTCOASTTIME', '@LUNCH', '@MORNING', '@SATURDAY', '@URGENT', '@WEEKEND', '@WORK']
+        >>> ch.wifi_provider.calls
+        1
+        """
         self.tags = tags
+        if wifi is None:
+            wifi = IwgetidWifi()
+        self.wifi_provider = wifi
+        if clock is None:
+            clock = datetime.datetime.now
+        self.clock = clock
+        self.take_snapshot()
+
+    def take_snapshot(self):
+        """ Fix the time, and forget the wifi, that the rules look at """
+        self.now = self.clock()
+        self.ssid = None
+        self.ssid_known = False
 
     def refresh(self):
         """ Remove stale tags, add more current ones """
+        self.take_snapshot()
         new_tags = []
+        table = ContextHandler.time_table
         for t in self.tags: # strip out auto_tags
-            if t not in ContextHandler.auto_tags:
+            if t not in ContextHandler.auto_tags and t not in table.tags:
                 new_tags += [t]
         for t in ContextHandler.auto_tags:
             if ContextHandler.auto_tags[t](self):
                 new_tags += [t]
+        new_tags += sorted(table.active(self.now))
         self.tags = new_tags
 
+    def next_change(self):
+        """ When the time based tags will next be different """
+        return ContextHandler.time_table.next_change(self.now)
+
     def get_tags(self):
         return self.tags
 
@@ -267,8 +548,72 @@ def indent_count(s):
 class TodoError(Exception):
     pass
 
-class Todo:
-    r""" Get string from ordered outline list, go up and find parents save parents in self.above.
+class OutlineNode:
+    r""" A line of the outline that other lines are nested under.
+    Each node works out the tags it passes on to its children once,
+    and shares them with every descendant.
+    >>> top = OutlineNode(',CONTEXTS')
+    >>> fred = OutlineNode('\t#FRED @HOME', top)
+    >>> fred.tags()
+    ['#FRED', '@HOME']
+    >>> fred.tags() is fred.tags()
+    True
+    >>> fred.lines()
+    [',CONTEXTS', '\t#FRED @HOME']
+    """
+    def __init__(self, line, parent=None, linenum=None):
+        self.line = line
+        self.parent = parent
+        self.linenum = linenum
+        self.tag_list = None
+        self.tag_names = None
+
+    def tags(self):
+        if self.tag_list is None:
+            if self.parent:
+                inherited = self.parent.tags()
+            else:
+                inherited = []
+            self.tag_list = inherited + Tag.extract_tags(self.line)
+        return self.tag_list
+
+    def tag_set(self):
+        if self.tag_names is None:
+            self.tag_names = frozenset(self.tags())
+        return self.tag_names
+
+    def lines(self):
+        above = []
+        n = self
+        while n:
+            above.append(n.line)
+            n = n.parent
+        above.reverse()
+        return above
+
+    @staticmethod
+    def ancestors(l, num):
+        """ Walk back from l[num] to build its chain of parents, returning
+        the nearest one (or None) """
+        chain = []
+        indent_above = indent_count(l[num]) - 1
+        for n in range(num-1, -1, -1):
+            if indent_above < 0:
+                break
+            ind = indent_count(l[n])
+            if ind <= indent_above:
+                # a shallower line than expected is still our parent
+                chain.append(l[n])
+                indent_above = ind - 1
+        parent = None
+        for line in reversed(chain):
+            parent = OutlineNode(line, parent)
+        return parent
+
+class Todo(object):
+    r""" A todo line from an ordered outline list, linked to the OutlineNode
+    it is nested under.  If no parent is given, go up and find the parents.
+    self.above lists the parents' lines followed by our own.
     >>> l = ['no0', '\tno1', 'yes0', '\tno1', '\t\tno2', '\tyes1', '\t\tyes2', '\t\tno2', '\tno1', 'no0' ]
     >>> i = Todo(l, 6)
     >>> print i.above
@@ -277,27 +622,30 @@ class Todo:
     '\t\tyes2'
     >>> print Todo(['#PYTHON','\ttest @FRED'], 1).above
     ['#PYTHON', '\ttest @FRED']
+    >>> print Todo(['#ELSEWHERE', ',PROJECTS','\t\tskipped a level'], 2).above
+    [',PROJECTS', '\t\tskipped a level']
     """
-    def __init__(self, l , num):
-        d = l[num]
-        above = [d]
-        indent_above = indent_count(d) - 1
-        for n in range(num-1, -1, -1):
-            if indent_above < 0:
-                break
-            if indent_count(l[n]) == indent_above:
-                above.append(l[n])
-                indent_above -= 1
-        above.reverse()
-        self.above = above
+    def __init__(self, l , num, parent=None):
+        if parent is None:
+            parent = OutlineNode.ancestors(l, num)
+        self.parent = parent
+        self.line = l[num]
         self.linenum = num
+        self.own_line = None
+        self.ignore_line = None
+
+    @property
+    def above(self):
+        if self.parent:
+            return self.parent.lines() + [self.line]
+        return [self.line]
 
     def get_todo_line(self):
         r""" Return main todo line 
         >>> Todo(['#PYTHON','\ttest @FRED'], 1).get_todo_line()
         '\ttest @FRED'
         """
-        return self.above[-1]
+        return self.line
 
     def set_todo_line(self, s):
         r""" Return main todo line 
@@ -306,7 +654,7 @@ class Todo:
         >>> print i.above
         ['#PYTHON', '\tbah']
         """
-        self.above[-1] = s
+        self.line = s
 
     def __str__(self):
         r"""
@@ -332,10 +680,26 @@ class Todo:
         >>> z.tags()
         ['#PYTHON', '@FRED']
         """
-        tags = []
-        for d in self.above:
-            tags += Tag.extract_tags(d)
-        return tags
+        return self.inherited_tags() + self.own_tags()
+
+    def inherited_tags(self):
+        if self.parent:
+            return self.parent.tags()
+        return []
+
+    def own_tags(self):
+        """ Tags on the todo line itself, recomputed only when it changes """
+        if self.own_line is not self.line:
+            self.own_line = self.line
+            self.own_tag_list = Tag.extract_tags(self.line)
+            self.own_tag_names = frozenset(self.own_tag_list)
+        return self.own_tag_list
+
+    def tag_set(self):
+        self.own_tags()
+        if self.parent:
+            return self.parent.tag_set() | self.own_tag_names
+        return self.own_tag_names
 
     def add_tag(self, t):
         r""" Add a tag 
@@ -377,11 +741,11 @@ class Todo:
         >>> print z.tags()
         ['#PYTHON']
         """
-        if t.name() not in self.above[-1]:
+        if t.name() not in self.line:
             raise TodoError("Can't remove tag %s" % t)
         if t.name() not in [i.name() for i in self.tags()]:
             raise TodoError('Tried to remove nonexistent tag')
-        (start, end) = t.find_in(self.above[-1])
+        (start, end) = t.find_in(self.line)
         todoline = self.get_todo_line()
         self.set_todo_line( todoline[:start] + todoline[end:] )
 
@@ -413,22 +777,317 @@ class Todo:
         >>> print z.year
         2005
         """
+        if self.ignore_line is not self.line:
+            self.ignore_time = self.find_ignore_until()
+            self.ignore_line = self.line
+        return self.ignore_time
+
+    def find_ignore_until(self):
         m = [i for i in self.tags() if i.is_ignore()]
         if not m:
             return datetime.datetime(datetime.MINYEAR, 1, 1)
         if len(m) != 1:
             raise TodoError("Too many ignore tags")
-        t = m[0]
-        return datetime.datetime.strptime(t.argument()[0], '%Y-%m-%dT%H:%M') # Move to subclass of Tag?
+        return m[0].ignore_time()
 
     def score(self, target_tags):
-       return len(set(self.tags()).intersection(target_tags))
+        r"""
+        >>> z = Todo(['#PYTHON', '\ttest @FRED @HOME' ], 1)
+        >>> z.score(['@HOME', '#PYTHON', '@WORK'])
+        2
+        """
+        return len(self.tag_set().intersection(target_tags))
+
+class TodoSection:
+    """ A run of lines starting at a top level (unindented) line.
+    todo_level is the indent at which todos live in this section, or None
+    if the section holds no todos.
+    """
+    headers = { ',INBOX' : 1, ',PROJECTS' : 2, ',CONTEXTS' : 2 }
+
+    def __init__(self, start, header=None):
+        self.start = start
+        self.end = start
+        self.todo_level = TodoSection.headers.get(header)
+        self.todos = []
+
+    def __repr__(self):
+        return 'TodoSection(%d, %d, %r)' % (self.start, self.end, self.todo_level)
+
+class TodoArchive:
+    r""" Finished todos, kept out of the live list in one append-only file
+    per month (gzipped if compress is set).  index.json records the first
+    and last timestamp and the number of entries in each segment, so a
+    date range only opens the segments it overlaps.
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> a = TodoArchive(d, compress=True)
+    >>> a.append(['\t2001-01-05T10:00-0000 X', '\t2001-02-01T09:00-0000 Y'])
+    >>> a.append(['\t2001-02-03T09:00-0000 Z'])
+    >>> sorted(os.listdir(d))
+    ['2001-01.txt.gz', '2001-02.txt.gz', 'index.json', 'index.json.lock']
+    >>> print ' '.join(map(str, a.index['2001-02.txt.gz']))
+    2001-02-01T09:00 2001-02-03T09:00 2
+    >>> list(TodoArchive(d).entries('2001-02-02'))
+    ['\t2001-02-03T09:00-0000 Z']
+    >>> shutil.rmtree(d)
+    """
+    stamp_re = re.compile(r'\s*(\d{4}-\d\d-\d\dT\d\d:\d\d)')
+
+    def __init__(self, directory, compress=None):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.index_filename = os.path.join(self.directory, 'index.json')
+        self.lock_filename = self.index_filename + '.lock'
+        self.index = self.read_index()
+        if compress is None:
+            # carry on however the archive was started
+            compress = any(n.endswith('.gz') for n in self.index)
+        self.compress = compress
+
+    @staticmethod
+    def default(filename="~/todo.txt"):
+        """ The archive next to filename, if there is one """
+        d = os.path.expanduser(filename) + '.archive'
+        if os.path.isdir(d):
+            return TodoArchive(d)
+        return None
+
+    def read_index(self):
+        try:
+            with open(self.index_filename) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def write_index(self):
+        tmp = '%s.%d' % (self.index_filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, sort_keys=True)
+        os.rename(tmp, self.index_filename)
+
+    def stamp(self, line):
+        m = self.stamp_re.match(line)
+        if m:
+            return m.group(1)
+        return time.strftime('%Y-%m-%dT%H:%M')
+
+    def segment(self, stamp):
+        name = stamp[:7] + '.txt'
+        if self.compress:
+            name += '.gz'
+        return name
+
+    def open_segment(self, name, mode):
+        path = os.path.join(self.directory, name)
+        if name.endswith('.gz'):
+            return gzip.open(path, mode)
+        return open(path, mode)
+
+    def append(self, lines):
+        """ Add finished lines to the segments for their months """
+        segments = collections.OrderedDict()
+        for l in lines:
+            stamp = self.stamp(l)
+            segments.setdefault(self.segment(stamp), []).append((stamp, l))
+        with open(self.lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.index = self.read_index()
+            for (name, entries) in segments.items():
+                f = self.open_segment(name, 'ab')
+                try:
+                    f.write(''.join(l + '\n' for (stamp, l) in entries))
+                finally:
+                    f.close()
+                stamps = [stamp for (stamp, l) in entries]
+                (first, last, count) = self.index.get(name, (stamps[0], stamps[0], 0))
+                self.index[name] = [min([first] + stamps), max([last] + stamps),
+                                    count + len(entries)]
+            self.write_index()
+
+    def entries(self, start=None, end=None):
+        """ Yield the archived lines stamped between start and end, which
+        are datetimes or timestamp strings """
+        if isinstance(start, datetime.datetime):
+            start = start.isoformat()[:16]
+        if isinstance(end, datetime.datetime):
+            end = end.isoformat()[:16]
+        for name in sorted(self.index, key=lambda n: self.index[n][0]):
+            (first, last, count) = self.index[name]
+            if (start and last < start) or (end and first >= end):
+                continue
+            f = self.open_segment(name, 'rb')
+            try:
+                for l in f:
+                    l = l.rstrip('\n')
+                    stamp = self.stamp(l)
+                    if (start and stamp < start) or (end and stamp >= end):
+                        continue
+                    yield l
+            finally:
+                f.close()
 
 class TodoList:
+    txn_depth = 0
+    txn_pending = False
+    archive = None
+
     def __init__(self, l = None):
         if not l or not isinstance(l, list):
             raise Exception, "TodoList needs a list"
         self.contents = l
+        self.archived = []
+        self.reset_index()
+
+    def reset_index(self):
+        """ Forget everything we know about the parsed list """
+        self.sections = None
+        self.dirty = None
+        self.tag_positions = {}
+        self.todos = []
+        self.tags = {}
+        self.wake_times = []
+        self.wake_todos = []
+        self.bad_wakeups = {} # id(todo) -> (todo, why) for unreadable IGNOREUNTILs
+        self.ops = []
+
+    def contents_changed(self):
+        """ True if the contents may have changed behind our back """
+        return False
+
+    def replace_lines(self, start, stop, lines):
+        r""" Replace contents[start:stop] with lines, noting the change so
+        the next parse_todos only re-reads the affected sections.
+        >>> i = TodoList([',INBOX','\tmust do X', ',CONTEXTS', '\t#FRED', '\t\tdo another thing @FOO'])
+        >>> i.parse_todos()
+        >>> i.replace_lines(2, 2, ['\tmust do Y @FOO'])
+        >>> i.dirty
+        (2, 2, 1)
+        >>> i.parse_todos()
+        >>> print i.todos
+        ['\tmust do X', '\tmust do Y @FOO', '\t\tdo another thing @FOO']
+        >>> print [t.linenum for t in i.tags['@FOO']]
+        [2, 5]
+        """
+        self.ops.append((start, self.contents[start:stop], list(lines)))
+        self.contents[start:stop] = lines
+        delta = len(lines) - (stop - start)
+        if self.dirty is None:
+            self.dirty = (start, stop, delta)
+            return
+        # merge with the outstanding dirty range, kept in the coordinates
+        # of the last parse: (first line, end line, change in length)
+        (lo, hi, d) = self.dirty
+        self.dirty = (min(lo, start), max(hi + d, stop) - d, d + delta)
+
+    def scan_sections(self, lines, start, end):
+        """ Parse lines[start:end], which must begin on a section boundary,
+        into a list of TodoSections """
+        sections = []
+        section = None
+        stack = [] # (indent, OutlineNode) for lines todos can be nested under
+        for i in range(start, end):
+            l = lines[i]
+            ind = indent_count(l)
+            if ind == 0 or section is None:
+                if section:
+                    section.end = i
+                section = TodoSection(i, l if ind == 0 else None)
+                sections.append(section)
+                stack = [(ind, OutlineNode(l, None, i))]
+                continue
+            level = section.todo_level
+            if level is None or ind > level:
+                continue
+            while stack and stack[-1][0] >= ind:
+                stack.pop()
+            if stack:
+                parent = stack[-1][1]
+            else:
+                parent = None
+            if ind == level:
+                section.todos.append(Todo(lines, i, parent))
+            else:
+                stack.append((ind, OutlineNode(l, parent, i)))
+        if section:
+            section.end = end
+        return sections
+
+    def index_todos(self, todos):
+        for todo in todos:
+            todo.indexed_tags = todo.tags()
+            for t in todo.indexed_tags:
+                self.tags.setdefault(t, [])
+                self.tags[t].append(todo)
+            self.add_wakeup(todo)
+
+    def unindex_todos(self, todos):
+        for todo in todos:
+            for t in todo.indexed_tags:
+                self.tags[t].remove(todo)
+                if not self.tags[t]:
+                    del self.tags[t]
+            self.remove_wakeup(todo)
+
+    def add_wakeup(self, todo):
+        """ Put a snoozed todo into the timeline of IGNOREUNTIL times """
+        try:
+            when = todo.ignore_until()
+        except (TodoError, ValueError), e:
+            # ranked_todos complains if it's ever a candidate
+            self.bad_wakeups[id(todo)] = (todo, e)
+            when = None
+        todo.indexed_wakeup = when
+        if when is None or when.year == datetime.MINYEAR:
+            return
+        n = bisect.bisect_right(self.wake_times, when)
+        self.wake_times.insert(n, when)
+        self.wake_todos.insert(n, todo)
+
+    def remove_wakeup(self, todo):
+        self.bad_wakeups.pop(id(todo), None)
+        when = todo.indexed_wakeup
+        if when is None or when.year == datetime.MINYEAR:
+            return
+        n = bisect.bisect_left(self.wake_times, when)
+        while self.wake_todos[n] is not todo:
+            n += 1
+        del self.wake_times[n]
+        del self.wake_todos[n]
+
+    def asleep(self, time_now):
+        """ The todos still being ignored at time_now """
+        self.parse_todos()
+        return self.wake_todos[bisect.bisect_right(self.wake_times, time_now):]
+
+    def wakeups(self, time_now=None):
+        r""" (time, todo) for each todo that will stop being ignored after
+        time_now, soonest first
+        >>> i = TodoList([',INBOX','\tX @IGNOREUNTIL(2005-05-05T12:10)','\tY', '\tZ @IGNOREUNTIL(2001-01-01T00:00)'])
+        >>> i.wakeups(datetime.datetime(2000, 1, 1))
+        [(datetime.datetime(2001, 1, 1, 0, 0), '\tZ @IGNOREUNTIL(2001-01-01T00:00)'), (datetime.datetime(2005, 5, 5, 12, 10), '\tX @IGNOREUNTIL(2005-05-05T12:10)')]
+        >>> i.replace_lines(2, 3, ['\tY @IGNOREUNTIL(2003-01-01T00:00)'])
+        >>> print [str(t).strip() for (w, t) in i.wakeups(datetime.datetime(2002, 1, 1))]
+        ['Y @IGNOREUNTIL(2003-01-01T00:00)', 'X @IGNOREUNTIL(2005-05-05T12:10)']
+        >>> print i.next_wakeup(datetime.datetime(2004, 1, 1))
+        2005-05-05 12:10:00
+        """
+        if time_now is None:
+            time_now = datetime.datetime.now()
+        self.parse_todos()
+        n = bisect.bisect_right(self.wake_times, time_now)
+        return zip(self.wake_times[n:], self.wake_todos[n:])
+
+    def next_wakeup(self, time_now=None):
+        """ When the next ignored todo wakes up, or None """
+        if time_now is None:
+            time_now = datetime.datetime.now()
+        self.parse_todos()
+        n = bisect.bisect_right(self.wake_times, time_now)
+        if n < len(self.wake_times):
+            return self.wake_times[n]
+        return None
 
     def parse_todos(self):
         r""" Find all todos in the todolist
@@ -438,68 +1097,166 @@ class TodoList:
         ['\tmust do X', '\tmust do Y', '\t\tdo another thing @FOO']
         >>> print i.todos[-1].tags()
         ['#FRED', '@FOO']
+        >>> i.replace_lines(0, 1, [',ELSEWHERE'])
+        >>> i.parse_todos()
+        >>> print i.todos
+        ['\t\tdo another thing @FOO']
         """
-        todos = []
-        tags = {}
-        state = 'TOP_LEVEL'
+        if self.sections is None or self.contents_changed() or not self.sections:
+            self.full_parse()
+        elif self.dirty is not None:
+            self.incremental_parse()
+
+    def full_parse(self):
         contents_copy = self.contents[:len(self.contents)]
-        for i in range(0, len(contents_copy)):
-            l = contents_copy[i]
-            ind = indent_count(l)
-            if ind == 0:
-                state = 'TOP_LEVEL'
-                todo_level = -1
-            if l == ',INBOX':
-                state = 'TODO'
-                todo_level = 1
-                continue
-            if l == ',PROJECTS':
-                state = 'TODO'
-                todo_level = 2
-                continue
-            if l == ',CONTEXTS':
-                state = 'TODO'
-                todo_level = 2
-                continue
-            if state == 'TODO' and ind == todo_level:
-                todo = Todo(contents_copy, i)
-                todos += [todo]
-                for i in todo.tags():
-                    tags.setdefault(i, [])
-                    tags[i] += [todo]
-        self.tags = tags
-        self.todos = todos
+        self.tags = {}
+        self.wake_times = []
+        self.wake_todos = []
+        self.bad_wakeups = {} # id(todo) -> (todo, why) for unreadable IGNOREUNTILs
+        self.sections = self.scan_sections(contents_copy, 0, len(contents_copy))
+        self.todos = []
+        for s in self.sections:
+            self.todos += s.todos
+        self.index_todos(self.todos)
+        self.dirty = None
+        self.tag_positions = {}
+
+    def incremental_parse(self):
+        """ Re-read only the sections touched since the last parse """
+        (lo, hi, delta) = self.dirty
+        self.dirty = None
+        self.tag_positions = {}
+        starts = [s.start for s in self.sections]
+        first = max(bisect.bisect_right(starts, lo) - 1, 0)
+        last = max(bisect.bisect_right(starts, max(hi - 1, lo)) - 1, first)
+        if first > 0 and self.sections[first].start == lo:
+            # the change may have removed or indented this section's header
+            first -= 1
+        start = self.sections[first].start
+        end = self.sections[last].end + delta
+        old = self.sections[first:last + 1]
+        for s in old:
+            self.unindex_todos(s.todos)
+        new = self.scan_sections(self.contents, start, end)
+        moved = set() # ids of outline nodes already shifted
+        for s in self.sections[last + 1:]:
+            s.start += delta
+            s.end += delta
+            for t in s.todos:
+                t.linenum += delta
+                n = t.parent
+                while n is not None and id(n) not in moved:
+                    moved.add(id(n))
+                    n.linenum += delta
+                    n = n.parent
+        self.sections[first:last + 1] = new
+        self.todos = []
+        for s in self.sections:
+            self.todos += s.todos
+        for s in new:
+            self.index_todos(s.todos)
+            for t in s.todos:
+                for tag in t.indexed_tags:
+                    self.tags[tag].sort(key=lambda x: x.linenum)
+
+    def positions(self, tag):
+        """ Where in self.todos the todos with this tag are, each once """
+        try:
+            return self.tag_positions[tag]
+        except KeyError:
+            pass
+        if not self.tag_positions:
+            self.todo_position = dict([(id(t), n) for (n, t) in enumerate(self.todos)])
+        p = sorted(set([self.todo_position[id(t)] for t in self.tags.get(tag, [])]))
+        if use_numpy(len(self.todos)):
+            p = numpy.array(p, dtype=numpy.intp)
+        self.tag_positions[tag] = p
+        return p
+
+    def context_scores(self, contexts):
+        """ Map each todo position sharing any tag with contexts to how many
+        of the contexts it has, in one pass over the contexts' todo lists """
+        contexts = set(contexts)
+        if use_numpy(len(self.todos)):
+            p = [self.positions(c) for c in contexts]
+            if not p:
+                return {}
+            counts = numpy.bincount(numpy.concatenate(p), minlength=len(self.todos))
+            hits = numpy.flatnonzero(counts)
+            return dict(zip(hits.tolist(), counts[hits].tolist()))
+        scores = {}
+        for c in contexts:
+            for n in self.positions(c):
+                scores[n] = scores.get(n, 0) + 1
+        return scores
+
+    def ranked_todos(self, contexts, count=1, time_now=None):
+        r""" The count best todos for these contexts, leaving out ignored ones.
+        Todos with equal scores come out in random order.  A candidate
+        whose IGNOREUNTIL can't be read is a TodoError.
+        >>> i = TodoList([',INBOX','\tX @HOME','\tY @HOME #FRED', '\tZ @HOME #FRED @IGNOREUNTIL(2999-01-01T00:00)', '\tW @WORK'])
+        >>> i.ranked_todos(['@HOME', '#FRED'], 5)
+        [('\tY @HOME #FRED', 2), ('\tX @HOME', 1)]
+        >>> i.replace_lines(4, 5, ['\tW @WORK @IGNOREUNTIL(soon)'])
+        >>> len(i.ranked_todos(['@HOME'], 5))
+        2
+        >>> i.ranked_todos(['@WORK'], 5)
+        Traceback (most recent call last):
+        TodoError: Can't tell when '\tW @WORK @IGNOREUNTIL(soon)' wakes up: time data 'soon' does not match format '%Y-%m-%dT%H:%M'
+        """
+        if time_now is None:
+            time_now = datetime.datetime.now()
+        self.parse_todos()
+        scores = self.context_scores(contexts)
+        asleep = set([id(t) for t in self.asleep(time_now)])
+        awake = [n for n in scores if id(self.todos[n]) not in asleep]
+        if self.bad_wakeups:
+            for n in awake:
+                if id(self.todos[n]) in self.bad_wakeups:
+                    (todo, why) = self.bad_wakeups[id(self.todos[n])]
+                    raise TodoError("Can't tell when %r wakes up: %s" % (str(todo), why))
+        best = heapq.nlargest(count, awake, key=lambda n: (scores[n], random.random()))
+        return [(self.todos[n], scores[n]) for n in best]
 
     def top_todo(self, contexts= []):
-        self.parse_todos()
         ct = self.current_todo()
-        time_now = datetime.datetime.now()
         if ct:
             return ct
-        context_score = 0
-        best_bet = None
-        tag_set = set(contexts)
-        randomizing_count = 1
-        for i in contexts:
-            todos_in_context = self.tags.setdefault(i, [])
-            for j in todos_in_context:
-                if j.ignore_until() > time_now:
-                    continue
-                this_score = j.score(tag_set)
-                if this_score >= context_score:
-                    randomizing_count += 1
-                    if this_score > context_score:
-                        randomizing_count  = 1
-                    if random.random() > (1.0/randomizing_count):
-                        continue
-                    context_score = this_score
-                    best_bet = j
-        if not best_bet:
-            best_bet = random.choice(self.todos)
-        self.contents[best_bet.linenum] += ' ' + Tag.current_tag()
-        self.sync()
+        best_bet = self.choose_todo(contexts)
+        self.make_current(best_bet)
         return best_bet
 
+    def choose_todo(self, contexts=[]):
+        """ The todo top_todo would pick, without changing anything """
+        ct = self.current_todo()
+        if ct:
+            return ct
+        best = self.ranked_todos(contexts)
+        if best:
+            return best[0][0]
+        return random.choice(self.todos)
+
+    def make_current(self, todo):
+        r""" Mark a todo, or the todo on a line with this text, as current,
+        unless some todo already is
+        >>> i = TodoList([',INBOX','\tmust do X','\tmust do Y'])
+        >>> i.make_current('\tmust do Y')
+        >>> i.make_current('\tmust do X')
+        >>> i.contents
+        [',INBOX', '\tmust do X', '\tmust do Y @CURRENT']
+        """
+        if self.current_todo():
+            return
+        if isinstance(todo, Todo):
+            n = todo.linenum
+        else:
+            found = [t.linenum for t in self.todos if self.contents[t.linenum] == todo]
+            if not found:
+                return # changed since it was chosen
+            n = found[0]
+        self.replace_lines(n, n + 1, [self.contents[n] + ' ' + Tag.current_tag()])
+        self.sync()
+
     def split_todo(self, original, addition):
         r"""
         >>> i = TodoList([',INBOX','\tmust do X','\tmust do Y @CURRENT', ',CONTEXTS', '\t#FRED', '\t\tdo another thing @FOO'])
@@ -515,7 +1272,7 @@ class TodoList:
         ',CONTEXTS'
         """
         """ Given an original todo, insert a new one underneath it """
-        self.contents[original.linenum:original.linenum+1] = [str(original), str(addition)]
+        self.replace_lines(original.linenum, original.linenum+1, [str(original), str(addition)])
         self.sync()
 
     def add_new_todo(self, newtodo):
@@ -535,7 +1292,7 @@ class TodoList:
             if self.contents[l].strip() == ',INBOX':
                 num_tabs = indent_count(self.contents[l]) + 1
                 indented_todo = '\t' * num_tabs + newtodo
-                self.contents[l:l + 1] = [',INBOX', indented_todo]
+                self.replace_lines(l, l + 1, [',INBOX', indented_todo])
                 self.sync()
                 return True
         return False
@@ -547,7 +1304,7 @@ class TodoList:
         True
         """
         self.parse_todos()
-        ct = self.tags.setdefault(Tag.current_tag(), [])
+        ct = self.tags.get(Tag.current_tag(), [])
         if not ct:
             return None
         if len(ct) > 1:
@@ -556,9 +1313,42 @@ class TodoList:
 
     def timestamped_append_to_bottom(self, l):
         l2 = '\t'+timestamp()+" " + l.lstrip()
-        self.contents[-1:] = [self.contents[-1], l2 ]
+        if self.archive is not None:
+            self.archived.append(l2)
+        else:
+            n = len(self.contents)
+            self.replace_lines(n, n, [l2])
         self.sync()
 
+    def done_lines(self):
+        """ Where the timestamped done entries at the bottom start """
+        n = len(self.contents)
+        while n > 0 and TodoArchive.stamp_re.match(self.contents[n - 1]) \
+                and self.contents[n - 1].startswith('\t'):
+            n -= 1
+        return n
+
+    def archive_done(self):
+        r""" Move the done entries off the bottom of the list into the archive
+        >>> import tempfile, shutil
+        >>> i = TodoList([',INBOX','\tmust do Y', '\t2001-01-05T10:00-0000 X'])
+        >>> i.archive = TodoArchive(tempfile.mkdtemp())
+        >>> i.archive_done()
+        1
+        >>> i.contents
+        [',INBOX', '\tmust do Y']
+        >>> list(i.archive.entries())
+        ['\t2001-01-05T10:00-0000 X']
+        >>> shutil.rmtree(i.archive.directory)
+        """
+        n = self.done_lines()
+        done = self.contents[n:]
+        if done:
+            self.archived.extend(done)
+            self.replace_lines(n, len(self.contents), [])
+            self.sync()
+        return len(done)
+
     def mark_current_done(self):
         r"""
         >>> i = TodoList([',INBOX','\tmust do X @CURRENT','\tmust do Y', ',CONTEXTS', '\t#FRED', '\t\tdo another thing @FOO'])
@@ -580,15 +1370,65 @@ class TodoList:
             # create ignoreuntil from this point
             ignore_tag = repeat_tag[0].ignore_from_repeat(datetime.datetime.now())
             current_todo.add_tag(ignore_tag)
-            self.contents[current_todo.linenum] = str(current_todo)
+            self.replace_lines(l, l + 1, [str(current_todo)])
             self.sync()
         else:
             # remove entry from current position
             # FIXME deal with multi-line todos
-            self.contents[l:l+2] = [self.contents[l+1]]
+            self.replace_lines(l, l+2, [self.contents[l+1]])
             # put timestamped copy at end of file
             self.timestamped_append_to_bottom(done)
 
+    def repeating_todos(self):
+        """ (todo, repeat tag) for every todo with a REPEAT tag """
+        self.parse_todos()
+        seen = set()
+        for (tag, todos) in self.tags.items():
+            if not tag.is_repeat():
+                continue
+            for t in todos:
+                if id(t) not in seen:
+                    seen.add(id(t))
+                    yield (t, tag)
+
+    def agenda(self, start=None, end=None, count=None):
+        r""" Yield (time, todo) for the coming occurrences of every repeating
+        todo between start and end, soonest first and at most count per todo.
+        A snoozed todo first comes back when its IGNOREUNTIL expires.
+        Occurrences are generated lazily and merged, so taking the first
+        few is cheap however many repeats there are.
+        >>> i = TodoList([',INBOX', '\tbins @REPEAT(WEEKLY)', '\tX', '\tpay @REPEAT(MONTHLY) @IGNOREUNTIL(2000-01-03T09:00)'])
+        >>> for (w, t) in i.agenda(datetime.datetime(2000, 1, 1), datetime.datetime(2000, 2, 10)): print w, str(t).strip()[:4]
+        2000-01-01 00:00:00 bins
+        2000-01-03 09:00:00 pay 
+        2000-01-08 00:00:00 bins
+        2000-01-15 00:00:00 bins
+        2000-01-22 00:00:00 bins
+        2000-01-29 00:00:00 bins
+        2000-02-03 09:00:00 pay 
+        2000-02-05 00:00:00 bins
+        >>> len(list(i.agenda(datetime.datetime(2000, 1, 1), datetime.datetime(2001, 1, 1), 2)))
+        4
+        """
+        if start is None:
+            start = datetime.datetime.now()
+        if end is None:
+            end = start + datetime.timedelta(days=7)
+        def occurrences(n, todo, tag):
+            try:
+                first = max(todo.ignore_until(), start)
+                rule = tag.repeat_rule(first)
+            except (TodoError, ValueError):
+                return
+            for (k, when) in enumerate(rule):
+                if when >= end or (count is not None and k >= count):
+                    return
+                yield (when, n, todo)
+        streams = [occurrences(n, todo, tag) for (n, (todo, tag))
+                   in enumerate(self.repeating_todos())]
+        for (when, n, todo) in heapq.merge(*streams):
+            yield (when, todo)
+
     def get_all_tags(self):
         self.parse_todos()
         return self.tags.keys()
@@ -598,40 +1438,628 @@ class TodoList:
         return self.todos
 
     def sync(self):
+        """ Save the contents, or note that they need saving once the
+        current transaction is over """
+        if self.txn_depth:
+            self.txn_pending = True
+            return
+        self.flush_archive()
+        self.write()
+        self.ops = []
+
+    def flush_archive(self):
+        # archive first: a failed write leaves a duplicate, never a loss
+        if self.archived:
+            self.archive.append(self.archived)
+            self.archived = []
+
+    def write(self):
         pass
 
+    @contextlib.contextmanager
+    def transaction(self):
+        r""" Gather up changes so they are written out in one sync at the end.
+        If anything goes wrong, writing them out included, the contents are
+        put back as they were.
+        >>> i = TodoList([',INBOX','\tmust do X @CURRENT','\tmust do Y', ',DONE'])
+        >>> with i.transaction():
+        ...     i.add_new_todo('must do Z')
+        ...     i.mark_current_done()
+        True
+        >>> i.contents[:4]
+        [',INBOX', '\tmust do Z', '\tmust do Y', ',DONE']
+        >>> with i.transaction():
+        ...     i.add_new_todo('must do W')
+        ...     i.mark_current_done()
+        Traceback (most recent call last):
+          ...
+        AttributeError: 'NoneType' object has no attribute 'linenum'
+        >>> i.contents[:4]
+        [',INBOX', '\tmust do Z', '\tmust do Y', ',DONE']
+        >>> def broken(): raise IOError("disk full")
+        >>> i.write = broken
+        >>> with i.transaction():
+        ...     i.add_new_todo('must do V')
+        Traceback (most recent call last):
+          ...
+        IOError: disk full
+        >>> i.contents[:4], i.ops
+        ([',INBOX', '\tmust do Z', '\tmust do Y', ',DONE'], [])
+        """
+        if self.txn_depth:
+            # already inside one; the outermost transaction does the work
+            yield self
+            return
+        saved = self.contents[:len(self.contents)]
+        saved_ops = self.ops[:]
+        saved_archived = self.archived[:]
+        self.txn_depth = 1
+        self.txn_pending = False
+        try:
+            yield self
+            self.txn_depth = 0
+            if self.txn_pending:
+                self.txn_pending = False
+                self.flush_archive()
+                self.write()
+                self.ops = []
+        except:
+            self.txn_depth = 0
+            self.txn_pending = False
+            self.contents = saved
+            self.reset_index()
+            self.ops = saved_ops
+            self.archived = saved_archived
+            raise
+
+    def dump_index(self):
+        r""" Flatten the parsed index into plain tuples, lists and dicts
+        (suitable for marshal) that restore_index can rebuild it from.
+        The index must be up to date: this doesn't parse.
+        >>> i = TodoList([',INBOX','\tmust do X @IGNOREUNTIL(2005-05-05T12:10)', ',CONTEXTS', '\t#FRED', '\t\tdo another thing @FOO'])
+        >>> i.parse_todos()
+        >>> j = TodoList(i.contents[:])
+        >>> j.restore_index(i.dump_index())
+        >>> print j.todos, j.sections
+        ['\tmust do X @IGNOREUNTIL(2005-05-05T12:10)', '\t\tdo another thing @FOO'] [TodoSection(0, 2, 1), TodoSection(2, 5, 2)]
+        >>> print sorted(j.tags.keys()), j.todos[1].tags()
+        ['#FRED', '@FOO', '@IGNOREUNTIL(2005-05-05T12:10)'] ['#FRED', '@FOO']
+        >>> print j.todos[0].ignore_until()
+        2005-05-05 12:10:00
+
+        After an incremental parse the lines below the change have moved:
+        >>> i.replace_lines(1, 1, ['\tnew thing @BAR'])
+        >>> i.parse_todos()
+        >>> k = TodoList(i.contents[:])
+        >>> k.restore_index(i.dump_index())
+        >>> print [t.tags() for t in k.todos]
+        [['@BAR'], ['@IGNOREUNTIL(2005-05-05T12:10)'], ['#FRED', '@FOO']]
+        >>> print [n.line for n in [k.todos[2].parent, k.todos[2].parent.parent]]
+        ['\t#FRED', ',CONTEXTS']
+        """
+        node_index = {}
+        todo_index = {}
+        nodes = []
+        tokens = {}
+        def add_node(n):
+            if n is None:
+                return -1
+            if id(n) not in node_index:
+                parent = add_node(n.parent)
+                node_index[id(n)] = len(nodes)
+                nodes.append((n.linenum, parent))
+                tokens[n.linenum] = [tuple(t) for t in Tag.tokenize(n.line)]
+            return node_index[id(n)]
+        sections = []
+        todos = []
+        ignores = {}
+        for (sn, section) in enumerate(self.sections):
+            sections.append((section.start, section.end, section.todo_level))
+            for t in section.todos:
+                todo_index[id(t)] = len(todos)
+                try:
+                    ignore = t.ignore_until()
+                except (TodoError, ValueError):
+                    ignore = None # leave it to be found (and complained about) later
+                if ignore is None or ignore.year != datetime.MINYEAR:
+                    ignores[len(todos)] = ignore and ignore.timetuple()[:5]
+                todos.append((t.linenum, add_node(t.parent), sn))
+                tokens[t.linenum] = [tuple(tok) for tok in Tag.tokenize(t.line)]
+        tags = {}
+        for (tag, l) in self.tags.items():
+            tags[str(tag)] = [todo_index[id(t)] for t in l]
+        return (sections, nodes, todos, tags, tokens, ignores)
+
+    def restore_index(self, index):
+        """ Rebuild the parsed index from dump_index without rescanning """
+        (sections, nodes, todos, tags, tokens, ignores) = index
+        for (linenum, toks) in tokens.items():
+            Tag.token_cache[self.contents[linenum]] = tuple([TagToken(*t) for t in toks])
+        self.sections = []
+        for (start, end, level) in sections:
+            section = TodoSection(start)
+            section.end = end
+            section.todo_level = level
+            self.sections.append(section)
+        outline = []
+        for (linenum, parent) in nodes:
+            if parent < 0:
+                parent = None
+            else:
+                parent = outline[parent]
+            outline.append(OutlineNode(self.contents[linenum], parent, linenum))
+        self.todos = []
+        for (n, (linenum, parent, sn)) in enumerate(todos):
+            if parent < 0:
+                parent = None
+            else:
+                parent = outline[parent]
+            t = Todo(self.contents, linenum, parent)
+            ignore = ignores.get(n, (datetime.MINYEAR, 1, 1))
+            if ignore:
+                t.ignore_line = t.line
+                t.ignore_time = datetime.datetime(*ignore)
+            t.indexed_tags = []
+            self.todos.append(t)
+            self.sections[sn].todos.append(t)
+        self.tags = {}
+        self.wake_times = []
+        self.wake_todos = []
+        self.bad_wakeups = {} # id(todo) -> (todo, why) for unreadable IGNOREUNTILs
+        for (tag, l) in tags.items():
+            tag = Tag.from_token(Tag.tokenize(tag)[0])
+            self.tags[tag] = [self.todos[n] for n in l]
+            for n in l:
+                self.todos[n].indexed_tags.append(tag)
+        for t in self.todos:
+            self.add_wakeup(t)
+        self.dirty = None
+        self.tag_positions = {}
+
 class TodoListVim(TodoList):
+    """ A todo list being edited in Vim.  We work on a copy of the buffer's
+    lines, and sync writes back only the lines that differ.
+    """
     def __init__(self, l=None):
+        import vimhelper
         if l == None:
-            vb = vimhelper.VimBuffer('TODO', 'todo.txt')
+            vb = vimhelper.VimBuffer('TODO', 'todo.txt', snapshot=True, channel=True)
         else:
             raise Exception, "Don't know how to open specific Vim instances yet"
-        self.contents = vb
+        self.buffer = vb
+        self.contents = vb[:]
+        self.archive = TodoArchive.default()
+        self.archived = []
+        self.reset_index()
+
+    def contents_changed(self):
+        # the buffer can be edited in Vim at any time, so check its changedtick
+        if self.buffer.refresh():
+            self.contents = self.buffer[:]
+            return True
+        return False
+
+    def write(self):
+        import vimhelper
+        try:
+            self.buffer.write_lines(self.contents)
+        except vimhelper.VimBufferChanged, e:
+            raise TodoError(str(e))
 
 class TodoListFile(TodoList):
-    def __init__(self, l="~/todo.txt"):
+    """ A todo list kept in a plain text file.  The parsed index is cached
+    in a dotfile next to it, so an unchanged list needn't be parsed again.
+
+    If todo.txt.archive exists (or archive=True) done entries go to a
+    TodoArchive there instead of the bottom of the list.
+
+    In journal mode (on if todo.txt.journal exists, or journal=True) a sync
+    appends the changed lines to the journal rather than rewriting the whole
+    list; loading replays the journal over the file.  Once the journal gets
+    big or old enough the next sync folds it back into the file.
+
+    Reads and writes take an flock on todo.txt.lock.  If someone else has
+    written the list since we read it, sync re-reads it and replays our
+    changes on top rather than overwriting theirs.
+    """
+    index_magic = 'TDX1'
+    index_header = struct.Struct('<4sdQ20s') # magic, mtime, size, sha1
+    journal_max_size = 64 * 1024
+    journal_max_age = 24 * 60 * 60
+
+    def __init__(self, l="~/todo.txt", journal=None, archive=None):
         self.filename = os.path.expanduser(l)
+        if archive:
+            self.archive = TodoArchive(self.filename + '.archive')
+        elif archive is None:
+            self.archive = TodoArchive.default(self.filename)
+        self.archived = []
+        self.index_filename = os.path.join(os.path.dirname(self.filename),
+                                           '.' + os.path.basename(self.filename) + '.idx')
+        self.journal_filename = self.filename + '.journal'
+        if journal is None:
+            journal = os.path.exists(self.journal_filename)
+        self.journal = journal
+        self.lock_filename = self.filename + '.lock'
+        self.index_wanted = None # identity of a sync whose index isn't saved yet
+        # loading may repair the journal, so needs the list to itself
+        with self.locked(self.journal and fcntl.LOCK_EX or fcntl.LOCK_SH):
+            self.load()
+        self.reset_index()
+
+    @contextlib.contextmanager
+    def locked(self, how=fcntl.LOCK_EX):
+        f = open(self.lock_filename, 'a')
+        try:
+            fcntl.flock(f.fileno(), how)
+            yield
+        finally:
+            f.close()
+
+    def load(self):
+        self.read_file()
+        if self.journal:
+            self.replay_journal()
+        self.disk = self.disk_state()
+
+    def refresh(self):
+        """ Re-read the list if someone else has written it since we loaded
+        it, for long running processes that keep one list around """
+        if self.disk_state() == self.disk:
+            return False
+        with self.locked(self.journal and fcntl.LOCK_EX or fcntl.LOCK_SH):
+            self.load()
+        self.reset_index()
+        return True
+
+    def disk_state(self):
+        """ What the list looks like on disk, cheaply: enough to tell if
+        anyone has written it """
+        st = os.stat(self.filename)
+        try:
+            journal = os.stat(self.journal_filename).st_size
+        except OSError:
+            journal = None
+        return (st.st_mtime, st.st_size, st.st_ino, journal)
+
+    def read_file(self):
         f=file(self.filename,'r')
-        self.contents = [i.rstrip() for i in f.readlines()]
+        st = os.fstat(f.fileno())
+        data = f.read()
+        f.close()
+        self.contents = [i.rstrip() for i in data.split('\n')]
+        if self.contents[-1] == '':
+            self.contents.pop()
+        self.file_written(st, data)
+
+    def file_written(self, st, data):
+        """ Note the identity of the file as it now is on disk """
+        self.base_mtime = st.st_mtime
+        self.base_id = [len(data), hashlib.sha1(data).hexdigest()]
+        self.state_hash = hashlib.sha1(data)
+        self.state_size = len(data)
+        self.update_identity()
+
+    def update_identity(self):
+        # covers the file plus any journal records replayed over it
+        self.identity = (self.base_mtime, self.state_size, self.state_hash.digest())
+
+    def start_journal(self):
+        f = open(self.journal_filename, 'w')
+        f.write(json.dumps({'base' : self.base_id, 'lines' : len(self.contents),
+                            'started' : time.time()}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.journal_started = time.time()
+        self.journal_size = 0
 
-    def sync(self):
+    def reject_journal(self, records, why):
+        """ Keep journal records we couldn't apply, and say so """
+        f = open(self.journal_filename + '.rejected', 'ab')
+        f.write(''.join([r + '\n' for r in records]))
+        f.close()
+        print >>sys.stderr, "%s: %s; %d change(s) saved in %s.rejected" % (
+            self.journal_filename, why, len(records), self.journal_filename)
+
+    def replay_journal(self):
+        r""" Apply the journal's records to the contents we've read.
+        A half-written last record is dropped.  If the file has been edited
+        since the journal was started (by hand, or in Vim) each record is
+        put where the lines it replaces are now found, as rebase does, and
+        the merged list is written straight back so the file is current
+        again.  Records that can't be placed are kept in .rejected, with a
+        warning, rather than lost.
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> print >>file(d + '/todo.txt', 'w'), ',INBOX\n\tmust do X\n,DONE'
+        >>> i = TodoListFile(d + '/todo.txt', journal=True)
+        >>> with i.transaction():
+        ...     i.add_new_todo('must do Y')
+        ...     i.timestamped_append_to_bottom('did Z')
+        True
+        >>> print file(d + '/todo.txt').read().split('\n')
+        [',INBOX', '\tmust do X', ',DONE', '']
+        >>> j = TodoListFile(d + '/todo.txt')
+        >>> j.contents == i.contents, j.journal
+        (True, True)
+        >>> j.compact() # doctest: +ELLIPSIS
+        Syncing ...
+        >>> print file(d + '/todo.txt').read() == '\n'.join(i.contents) + '\n'
+        True
+        >>> len(TodoListFile(d + '/todo.txt').contents)
+        5
+        >>> k = TodoListFile(d + '/todo.txt')
+        >>> k.add_new_todo('B from journal')
+        True
+        >>> print >>file(d + '/todo.txt', 'a'), '\tC added by hand'
+        >>> c = TodoListFile(d + '/todo.txt').contents # doctest: +ELLIPSIS
+        Syncing ...
+        >>> c[1], c[-1]
+        ('\tB from journal', '\tC added by hand')
+        >>> file(d + '/todo.txt').read().split('\n') == c + ['']
+        True
+        >>> shutil.rmtree(d)
+        """
+        compacting = self.journal_filename + '.compacting'
+        if os.path.exists(compacting) and not os.path.exists(self.journal_filename):
+            try:
+                base = json.loads(file(compacting).readline())['base']
+            except (ValueError, KeyError, TypeError):
+                base = None
+            if base == self.base_id:
+                os.rename(compacting, self.journal_filename) # never got written
+            else:
+                os.unlink(compacting) # already folded into the file
+        try:
+            f = open(self.journal_filename, 'rb')
+        except IOError:
+            self.start_journal()
+            return
+        data = f.read()
+        f.close()
+        try:
+            (header_line, data) = data.split('\n', 1)
+            header = json.loads(header_line)
+            self.journal_started = header['started']
+        except (ValueError, KeyError, TypeError):
+            if data:
+                self.reject_journal([data], "unreadable journal header")
+            self.start_journal()
+            return
+        same_base = header.get('base') == self.base_id
+        length = header.get('lines') # of the file the journal started from
+        records = data.split('\n')[:-1]
+        good = 0
+        shift = 0
+        rejected = []
+        for record in records:
+            try:
+                (start, old, new) = json.loads(record)
+            except ValueError:
+                break # torn off by a crash
+            good += len(record) + 1
+            old = [i.encode('latin-1') for i in old]
+            new = [i.encode('latin-1') for i in new]
+            if same_base and self.contents[start:start + len(old)] == old:
+                place = start
+            elif not old and start == length:
+                place = len(self.contents) # appended at the end
+            else:
+                place = self.find_lines(old, start + shift)
+            if length is not None:
+                length += len(new) - len(old)
+            if place is None:
+                rejected.append(record)
+                continue
+            self.contents[place:place + len(old)] = new
+            shift = place - start
+            if same_base:
+                self.state_hash.update(record + '\n')
+        if rejected:
+            self.reject_journal(rejected, "lines these changes replace have gone")
+        if not same_base or rejected:
+            if not same_base:
+                print >>sys.stderr, "%s was edited outside the journal; merging %d change(s) into it" % (
+                    self.filename, len(records) - len(rejected))
+            self.write_file() # also starts a fresh journal
+            return
+        if good < len(data):
+            f = open(self.journal_filename, 'r+b')
+            f.truncate(len(header_line) + 1 + good)
+            f.close()
+        self.journal_size = good
+        self.state_size += good
+        self.update_identity()
+
+    def full_parse(self):
+        if self.load_index():
+            return
+        TodoList.full_parse(self)
+        self.save_index()
+
+    def parse_todos(self):
+        TodoList.parse_todos(self)
+        # a sync left the cache to us, and we still match the file
+        if self.index_wanted == self.identity and not self.ops:
+            self.save_index()
+
+    def load_index(self):
+        """ Restore the parsed index if the cache matches the file we read """
+        try:
+            f = open(self.index_filename, 'rb')
+        except IOError:
+            return False
+        try:
+            header = TodoListFile.index_header
+            data = f.read(header.size)
+            if len(data) < header.size:
+                return False
+            (magic, mtime, size, digest) = header.unpack(data)
+            if (magic != TodoListFile.index_magic or
+                (mtime, size, digest) != self.identity):
+                return False
+            index = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return False
+        finally:
+            f.close()
+        self.restore_index(index)
+        return True
+
+    def save_index(self):
+        """ Cache the parsed index for the file as it is now.  If it's been
+        changed since the last parse, leave that until the next one rather
+        than parse just for the cache. """
+        self.index_wanted = None
+        if self.sections is None:
+            return # never parsed, so nothing worth caching
+        if self.dirty is not None:
+            self.index_wanted = self.identity
+            return
+        (mtime, size, digest) = self.identity
+        tmp = '%s~%d' % (self.index_filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            f.write(TodoListFile.index_header.pack(TodoListFile.index_magic, mtime, size, digest))
+            marshal.dump(self.dump_index(), f)
+            f.close()
+            os.rename(tmp, self.index_filename)
+        except (IOError, OSError):
+            pass # the cache is only an optimisation
+
+    def write(self):
+        with self.locked():
+            try:
+                if self.disk_state() != self.disk:
+                    self.rebase()
+                if self.journal and not self.journal_due():
+                    self.append_journal()
+                else:
+                    self.write_file()
+            except:
+                # the caller may roll back to contents from before a
+                # rebase, so make sure the next write rebases again
+                self.disk = None
+                raise
+            self.disk = self.disk_state()
+        self.save_index()
+
+    def rebase(self):
+        r""" Someone else has written the list since we read it: read it
+        again and replay our unsaved changes over their version.  Each change
+        is put where the lines it replaced are now found, nearest to where
+        they were; lines we appended still go at the end.
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> print >>file(d + '/todo.txt', 'w'), ',INBOX\n\tmust do X @CURRENT\n,DONE'
+        >>> i = TodoListFile(d + '/todo.txt')
+        >>> j = TodoListFile(d + '/todo.txt')
+        >>> i.add_new_todo('from i') # doctest: +ELLIPSIS
+        Syncing ...
+        True
+        >>> j.mark_current_done() # doctest: +ELLIPSIS
+        Syncing ...
+        >>> c = TodoListFile(d + '/todo.txt').contents
+        >>> c[:3], c[3].endswith(' must do X @CURRENT')
+        ([',INBOX', '\tfrom i', ',DONE'], True)
+        >>> shutil.rmtree(d)
+        """
+        ops = self.ops
+        length = len(self.contents) - sum([len(new) - len(old) for (start, old, new) in ops])
+        self.load()
+        self.reset_index()
+        shift = 0
+        for (start, old, new) in ops:
+            if not old and start == length:
+                place = len(self.contents)
+            else:
+                place = self.find_lines(old, start + shift)
+            if place is None:
+                raise TodoError("Can't merge our changes into %s: %r has gone" % (self.filename, old))
+            self.replace_lines(place, place + len(old), new)
+            shift = place - start
+            length += len(new) - len(old)
+
+    def find_lines(self, lines, near):
+        """ Position of the run of lines nearest to near, or None """
+        if not lines:
+            return max(0, min(near, len(self.contents)))
+        best = None
+        for i in range(len(self.contents) - len(lines) + 1):
+            if self.contents[i] == lines[0] and self.contents[i:i + len(lines)] == lines:
+                if best is None or abs(i - near) < abs(best - near):
+                    best = i
+        return best
+
+    def journal_due(self):
+        """ Is it time to fold the journal back into the file? """
+        return (self.journal_size > TodoListFile.journal_max_size or
+                time.time() - self.journal_started > TodoListFile.journal_max_age)
+
+    def append_journal(self):
+        records = ''.join([json.dumps(op, encoding='latin-1') + '\n' for op in self.ops])
+        f = open(self.journal_filename, 'ab')
+        f.write(records)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.journal_size += len(records)
+        self.state_hash.update(records)
+        self.state_size += len(records)
+        self.update_identity()
+
+    def compact(self):
+        """ Write out the whole file and start a fresh journal """
+        self.write_file()
+        self.save_index()
+
+    def write_file(self):
         print("Syncing " + self.filename)
         filename = self.filename
         if os.path.islink(filename):
             linkname = os.readlink(filename)
             filename = os.path.join(os.path.dirname(self.filename),linkname)
         filename_tmp = filename+"~"
-        # when this screws up, you should probably add some file locking
+        data = ''.join([i+'\n' for i in self.contents])
         f=open(filename_tmp, 'w')
-        f.writelines([i+'\n' for i in self.contents])
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        compacting = self.journal_filename + '.compacting'
+        if self.journal and os.path.exists(self.journal_filename):
+            # set the journal aside first: if we crash before the rename
+            # below, loading finds it still matches the old file and replays
+            # it; if after, it doesn't match and is already in the file
+            os.rename(self.journal_filename, compacting)
         os.rename(filename_tmp, filename)
-
-def DefaultTodoList():
+        self.file_written(os.stat(filename), data)
+        if self.journal:
+            self.start_journal()
+            if os.path.exists(compacting):
+                os.unlink(compacting)
+
+keep_resident = False # set by long running processes, see tnext --serve
+resident = None
+
+def DefaultTodoList(shared=True):
+    """ The todo list open in Vim, or else ~/todo.txt.  Pass shared=False
+    for a list of your own rather than a long running process's resident
+    one, e.g. from a thread that may outlive its caller. """
+    global resident
+    import vimhelper
     try:
         return TodoListVim()
     except vimhelper.VimBufferNotFound:
+        pass
+    if not keep_resident or not shared:
         return TodoListFile()
+    if resident is None:
+        resident = TodoListFile()
+    else:
+        resident.refresh()
+    return resident
  
 def main(args):
     """ Put your main command line runner here """
@@ -17,6 +17,12 @@ __cvsversion__ = "$Revision$"
 __date__ = "$Date$"
 
 import logging
+import socket
+import json
+import difflib
+import os
+import time
+import hmac
 #rootLogger = logging.getLogger('')
 #rootLogger.setLevel(logging.DEBUG)
 
@@ -40,11 +46,215 @@ def vimrepr(o):
     else:
         return z
 
+def vimlist(l):
+    r""" Make a Vim list of strings
+    >>> print vimlist(['a', '\tb', "it's"])
+    ["a","\tb","it's"]
+    """
+    return '[' + ','.join([vimrepr(i) for i in l]) + ']'
+
+def line_diff(old, new):
+    r""" The edits that turn the list old into new, as (op, start, stop, lines)
+    tuples with 0-based positions in old, last edit first so each can be
+    applied without disturbing the positions of the rest.
+    >>> line_diff(['a', 'b', 'c', 'd'], ['top', 'a', 'B', 'c'])
+    [('delete', 3, 4, []), ('replace', 1, 2, ['B']), ('insert', 0, 0, ['top'])]
+    >>> line_diff(['a', 'b'], ['a', 'b'])
+    []
+    """
+    # only hand the changed middle to SequenceMatcher
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix and
+           old[len(old) - suffix - 1] == new[len(new) - suffix - 1]):
+        suffix += 1
+    a = old[prefix:len(old) - suffix]
+    b = new[prefix:len(new) - suffix]
+    edits = []
+    for (op, i1, i2, j1, j2) in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if op != 'equal':
+            edits.append((op, prefix + i1, prefix + i2, b[j1:j2]))
+    edits.reverse()
+    return edits
+
+class VimBufferChanged(Exception):
+    pass
+
+class VimChannelError(Exception):
+    pass
+
+def vimresult(v):
+    r""" Turn a value from a Vim channel into what --remote-expr would print
+    >>> vimresult(3)
+    '3'
+    >>> vimresult([u'a', u'b'])
+    'a\nb'
+    >>> vimresult(u'caf\xe9\n')
+    'caf\xc3\xa9'
+    """
+    if isinstance(v, list):
+        return '\n'.join([vimresult(i) for i in v])
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    return str(v).rstrip('\n')
+
+class VimChannel:
+    """ A JSON mode channel that a Vim has opened to us.  Requests are
+    ["expr", expression, -serial]; Vim answers [-serial, result], one
+    message per line.  Many requests can be in flight at once.
+
+    Any local process can connect to the port we listen on, so the Vim we
+    ask to connect first sends a random token, and connections that don't
+    are dropped.
+    """
+    timeout = 5
+
+    @staticmethod
+    def listen():
+        """ A socket for Vim to connect to, and the token it must send """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(1)
+        return (s, os.urandom(16).encode('hex'))
+
+    @staticmethod
+    def open_command(listener, token, variable='g:vimhelper_channel'):
+        r""" The Ex command that has Vim connect to listener and send token
+        >>> s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        >>> s.bind(('127.0.0.1', 0))
+        >>> print VimChannel.open_command(s, 'abc', 'g:c').replace(str(s.getsockname()[1]), 'PORT')
+        let g:c = ch_open("127.0.0.1:PORT", {"mode": "json"}) | call ch_sendraw(g:c, "abc\n")
+        >>> s.close()
+        """
+        return 'let %s = ch_open("127.0.0.1:%d", {"mode": "json"}) | call ch_sendraw(%s, "%s\\n")' % (
+            variable, listener.getsockname()[1], variable, token)
+
+    @staticmethod
+    def accept(listener, token):
+        """ The channel from the first connection to send token """
+        deadline = time.time() + VimChannel.timeout
+        try:
+            while True:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise VimChannelError("Vim never connected")
+                listener.settimeout(left)
+                try:
+                    (conn, addr) = listener.accept()
+                except socket.timeout:
+                    raise VimChannelError("Vim never connected")
+                conn.settimeout(max(left, 0.1))
+                channel = VimChannel(conn)
+                try:
+                    sent = channel.readline()
+                except VimChannelError:
+                    sent = ''
+                if hmac.compare_digest(sent, token):
+                    conn.settimeout(VimChannel.timeout)
+                    return channel
+                logging.warning("dropped a connection to the Vim channel that didn't send our token")
+                conn.close()
+        finally:
+            listener.close()
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.serial = 0
+        self.buf = ''
+        self.replies = {}
+
+    def send(self, message):
+        try:
+            self.sock.sendall(json.dumps(message) + '\n')
+        except socket.error, e:
+            raise VimChannelError(str(e))
+
+    def ex(self, command):
+        """ Run an Ex command; Vim sends no reply """
+        self.send(['ex', command])
+
+    def exprs(self, expressions):
+        """ Evaluate a batch of expressions, sending them all before
+        waiting for any of the answers """
+        ids = []
+        for e in expressions:
+            self.serial += 1
+            ids.append(-self.serial)
+            self.send(['expr', e, -self.serial])
+        return [self.reply(i) for i in ids]
+
+    def expr(self, expression):
+        return self.exprs([expression])[0]
+
+    def readline(self):
+        while '\n' not in self.buf:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error, e:
+                raise VimChannelError(str(e))
+            if not data:
+                raise VimChannelError("Vim closed the channel")
+            self.buf += data
+        (line, self.buf) = self.buf.split('\n', 1)
+        return line
+
+    def reply(self, n):
+        while n not in self.replies:
+            line = self.readline()
+            try:
+                (serial, result) = json.loads(line)
+            except ValueError:
+                continue # not an answer to us
+            self.replies[serial] = result
+        return self.replies.pop(n)
+
+    def close(self):
+        self.sock.close()
+
 class VimProxy:
+    """ Talk to a Vim server.  Each call normally runs a vim client with
+    --remote-expr or --remote-send.  With channel=True we ask the server to
+    open a channel back to us instead, and send expressions down that;
+    if that can't be done we quietly stay with the clients.
+    """
     def __init__(self, servername):
         self.servername = servername
-    
+        self.channel = None
+
+    def try_channel(self):
+        """ Switch to a channel if the server will open one """
+        try:
+            self.open_channel()
+        except (VimChannelError, socket.error), e:
+            logging.debug("no channel to %s: %s" % (self.servername, e))
+        return self.channel is not None
+
+    def open_channel(self):
+        (listener, token) = VimChannel.listen()
+        try:
+            status = self.do('execute(%s).ch_status(g:vimhelper_channel)' %
+                vimrepr(VimChannel.open_command(listener, token)))
+            if status != 'open':
+                raise VimChannelError("Vim couldn't open a channel: %r" % status)
+        except:
+            listener.close()
+            raise
+        self.channel = VimChannel.accept(listener, token)
+
+    def do_many(self, commands):
+        """ Evaluate several expressions, in one round trip if we can """
+        if self.channel:
+            logging.debug("calling functions %s" % (commands,))
+            return [vimresult(i) for i in self.channel.exprs(commands)]
+        return [self.do(c) for c in commands]
+
     def do(self,command, remoteform='remote-expr'):
+        if self.channel and remoteform == 'remote-expr':
+            logging.debug("calling function %s" % command)
+            return vimresult(self.channel.expr(command))
         r = '--'+remoteform
         if r == "--remote-expr":
             logging.debug("calling function %s" % command)
@@ -67,7 +277,24 @@ class VimProxy:
 class VimBufferNotFound(Exception):
     pass
 
+def parse_snapshot(r):
+    r""" Split the reply to VimBuffer.take_snapshot into (changedtick, lines)
+    >>> parse_snapshot('42\nfirst\n\nlast\n.')
+    (42, ['first', '', 'last', ''])
+    >>> parse_snapshot('7\n.')
+    (7, [''])
+    """
+    if not r.endswith('.'):
+        raise VimBufferNotFound("Bad snapshot reply from Vim")
+    (tick, text) = r[:-1].split('\n', 1)
+    return (int(tick), text.split('\n'))
+
 class VimBuffer():
+    """ A list-like view of a buffer in a running Vim.
+    In snapshot mode the whole buffer is fetched in one remote call, and
+    reads are served from that copy until refresh() sees Vim's changedtick
+    move on.
+    """
     def __repr__(self):
         s = 'VimBuffer(%s,%s): [' % (self.server, self.buffer)
         if self.__len__()==0:
@@ -76,18 +303,55 @@ class VimBuffer():
             s += repr(i)+", "
         return s[0:-2]+"]"
 
-    def __init__(self, server, buffername):
+    def __init__(self, server, buffername, snapshot=False, channel=False, proxy=None):
         self.server = server
         self.buffer = buffername
-        self.vimp = VimProxy(server)
+        if proxy is None:
+            proxy = VimProxy(server)
+        self.vimp = proxy
+        self.snapshot_mode = snapshot
+        self.snap = None
+        self.snap_tick = None
         try:
-            self.bufnum = int(self.vimp.bufexists(buffername))
+            self.bufnum = int(self.vimp.bufnr(buffername))
         except ValueError:
             raise VimBufferNotFound("Could not find " + self.buffer)
-        
+        if self.bufnum < 1:
+            raise VimBufferNotFound("No buffer " + self.buffer)
+        if channel:
+            self.vimp.try_channel()
+
+    def changedtick(self):
+        return int(self.vimp.getbufvar(self.bufnum, 'changedtick'))
+
+    def take_snapshot(self):
+        """ Fetch changedtick and every line of the buffer in one call """
+        # the trailing '.' stops do() eating trailing blank lines
+        r = self.vimp.do('getbufvar(%d,"changedtick")."\\n".join(getbufline(%d,1,"$"),"\\n")."."'
+                         % (self.bufnum, self.bufnum))
+        (tick, text) = parse_snapshot(r)
+        self.snap_tick = tick
+        self.snap = text
+
+    def refresh(self):
+        """ Make sure the snapshot is current, returning True if it had to
+        be fetched again """
+        if self.snap is not None and self.changedtick() == self.snap_tick:
+            return False
+        self.take_snapshot()
+        return True
+
     def __getitem__(self, n):
+        if self.snapshot_mode:
+            if self.snap is None:
+                self.take_snapshot()
+            return self.snap[n]
         if isinstance(n, slice):
-            return self.vimp.getline(n.start+1, n.stop+1).split('\n')
+            # same as slicing the snapshot: stop is exclusive
+            (start, stop, step) = n.indices(len(self))
+            if stop <= start:
+                return []
+            return self.vimp.getline(start+1, stop).split('\n')[::step]
         if n<0:
             n = len(self)+n
         l=self.vimp.getline(n+1)
@@ -110,6 +374,67 @@ class VimBuffer():
         for l in value:
             self.vimp.sendkeys(l+'\n')
         self.vimp.sendkeys('.\n')
+        self.written(start, stop, value)
+
+    def write_lines(self, new):
+        """ Make the buffer hold the lines in new, sending only the lines that
+        differ from our snapshot, all in one remote call.  Vim records the
+        whole change as a single undo step.  Raises VimBufferChanged, and
+        changes nothing, if the buffer has moved on since the snapshot.
+        """
+        if self.snap is None:
+            self.take_snapshot()
+        b = self.bufnum
+        calls = []
+        for (op, start, stop, lines) in line_diff(self.snap, new):
+            if op == 'insert':
+                calls.append('appendbufline(%d,%d,%s)' % (b, start, vimlist(lines)))
+                continue
+            common = min(stop - start, len(lines))
+            if common:
+                calls.append('setbufline(%d,%d,%s)' % (b, start + 1, vimlist(lines[:common])))
+            if stop - start > common:
+                calls.append('deletebufline(%d,%d,%d)' % (b, start + common + 1, stop))
+            elif len(lines) > common:
+                calls.append('appendbufline(%d,%d,%s)' % (b, stop, vimlist(lines[common:])))
+        if not calls:
+            return
+        if not new:
+            calls.append('setbufline(%d,1,"")' % b) # a buffer always has a line
+        # break the undo sequence first so the change undoes on its own
+        calls.insert(0, 'execute("let &undolevels = &undolevels")')
+        calls.append('getbufvar(%d,"changedtick")' % b)
+        r = self.vimp.do('getbufvar(%d,"changedtick")==%d ? [%s][-1] : -1'
+                         % (b, self.snap_tick, ','.join(calls)))
+        try:
+            tick = int(r)
+        except ValueError:
+            raise VimBufferChanged("Odd reply writing to %s: %r" % (self.buffer, r))
+        if tick < 0:
+            raise VimBufferChanged("%s changed in Vim since we read it" % self.buffer)
+        self.snap = list(new) or ['']
+        self.snap_tick = tick
+
+    def written(self, start, stop, value):
+        """ Apply a change we've made in Vim to our snapshot too.  We can't
+        be sure what keys we sent ended up as (autoindent, for one), so
+        fetch back what's now there, and if the buffer isn't the length we
+        expect drop the snapshot to be taken again. """
+        if self.snap is None:
+            return
+        b = self.bufnum
+        r = self.vimp.do('getbufvar(%d,"changedtick")."\\n".len(getbufline(%d,1,"$"))."\\n".join(getbufline(%d,%d,%d),"\\n")."."'
+                         % (b, b, b, start + 1, start + len(value)))
+        (tick, lines) = parse_snapshot(r)
+        length = int(lines.pop(0))
+        if not value:
+            lines = []
+        snap = self.snap[:start] + lines + self.snap[stop:]
+        if len(snap) != length or len(lines) != len(value):
+            self.snap = None
+            return
+        self.snap = snap
+        self.snap_tick = tick
         
     def __setitem__(self, n, v):
         if isinstance(n, slice):
@@ -118,12 +443,17 @@ class VimBuffer():
         m=self.vimp.setline(n+1, v)
         if not m:
             raise IndexError
+        self.written(n, n+1, [v])
 
     def __len__(self):
+        if self.snapshot_mode:
+            if self.snap is None:
+                self.take_snapshot()
+            return len(self.snap)
         return int(self.vimp.line('$'))
 
     def __iter__(self):
-        z = self[0:-1]
+        z = self[:]
         for l in z:
             yield l
  
@@ -18,6 +18,8 @@ import os.path
 import todo
 import datetime
 import subprocess
+import json
+import fcntl
 from paver.easy import *
 
 MINIMUM_PRIORITY = 0
@@ -27,13 +29,128 @@ TOP_PRIORITY = 100
 TWEAK_PRIORITY = 10 # tweaking up or down
 
 private_store = os.path.expanduser('~/Private/lifehacking/')
-if not os.path.exists(private_store):
-    os.makedirs(private_store)
+
+def private_path(name):
+    """ A file in the private store, which is created the first time it's needed """
+    if not os.path.exists(private_store):
+        os.makedirs(private_store)
+    return os.path.join(private_store, name)
+
+def latin1_str(v):
+    """ Turn the unicode json gives back into the byte strings we stored """
+    if isinstance(v, unicode):
+        return v.encode('latin-1')
+    if isinstance(v, list):
+        return [latin1_str(i) for i in v]
+    if isinstance(v, dict):
+        return dict((latin1_str(k), latin1_str(i)) for (k, i) in v.items())
+    return v
+
+class Settings:
+    r""" Small settings kept together in one JSON file.  Reads are cached
+    until the file's mtime changes; writes take a lock, merge with what's on
+    disk and atomically replace the file.  Keys not in the file are looked
+    for in legacy_dir, where they used to be one file each, and moved in;
+    the old file is renamed to key.migrated.
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> file(os.path.join(d, 'old'), 'w').write('from before\n')
+    >>> s = Settings(os.path.join(d, 'settings.json'), legacy_dir=d)
+    >>> s.update({'a': '1', 'b': ['x', 'y']})
+    >>> s.get_many(['a', 'b', 'c'])
+    {'a': '1', 'c': None, 'b': ['x', 'y']}
+    >>> Settings(s.filename).get('a')
+    '1'
+    >>> s.get('old')
+    'from before'
+    >>> os.path.exists(os.path.join(d, 'old')), os.path.exists(os.path.join(d, 'old.migrated'))
+    (False, True)
+    >>> Settings(s.filename).get('old')
+    'from before'
+    >>> shutil.rmtree(d)
+    """
+    def __init__(self, filename, legacy_dir=None):
+        self.filename = os.path.expanduser(filename)
+        self.lock_filename = self.filename + '.lock'
+        self.legacy_dir = legacy_dir
+        self.data = {}
+        self.stamp = None
+        self.looked_for = set() # keys already sought in legacy_dir
+
+    def file_stamp(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def load(self):
+        """ All the settings, read from disk only if it's changed """
+        stamp = self.file_stamp()
+        if stamp != self.stamp:
+            try:
+                with open(self.filename) as f:
+                    self.data = latin1_str(json.load(f))
+            except (IOError, ValueError):
+                self.data = {}
+            self.stamp = stamp
+        return self.data
+
+    def get(self, key, default=None):
+        return self.get_many([key], default)[key]
+
+    def get_many(self, keys, default=None):
+        data = self.load()
+        legacy = [k for k in keys if k not in data and k not in self.looked_for]
+        if legacy and self.legacy_dir:
+            self.looked_for.update(legacy)
+            self.migrate(legacy)
+            data = self.load()
+        return dict((k, data.get(k, default)) for k in keys)
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        """ Set several settings with one write """
+        d = os.path.dirname(self.filename)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        with open(self.lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.stamp = None # make sure we merge with the latest
+            data = dict(self.load())
+            data.update(values)
+            tmp = '%s~%d' % (self.filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(data, f, encoding='latin-1', sort_keys=True)
+            os.rename(tmp, self.filename)
+            self.data = data
+            self.stamp = self.file_stamp()
+
+    def migrate(self, keys):
+        """ Move the legacy one-file-per-key settings for keys into the store """
+        found = {}
+        for k in keys:
+            try:
+                found[k] = file(os.path.join(self.legacy_dir, k)).read().rstrip()
+            except IOError:
+                pass
+        if found:
+            self.update(found)
+            for k in found: # kept, but out of the way
+                old = os.path.join(self.legacy_dir, k)
+                os.rename(old, old + '.migrated')
+
+settings = Settings(os.path.join(private_store, 'settings.json'),
+                    legacy_dir=private_store)
 
 def store_setting(key, value):
-    f = file(os.path.expanduser('~/Private/lifehacking/'+key),'w')
-    print >>f, value
-    f.close()
+    settings.set(key, str(value))
+
+def store_setting_value(key, value):
+    """ Like store_setting, but keeps lists and dicts as they are """
+    settings.set(key, value)
 
 def get_setting(key):
     """
@@ -43,27 +160,26 @@ def get_setting(key):
     >>> print get_setting('nonexistent')
     None
     """
-    try:
-        f = file(os.path.expanduser('~/Private/lifehacking/'+key),'r')
-        i = f.read().rstrip()
-        f.close()
-        return i
-    except IOError:
-        return None
+    return settings.get(key)
 
 
 class Order():
-    def __init__(self, description="No orders", command='', alt_command='', priority=DEFAULT_PRIORITY):
+    def __init__(self, description="No orders", command='', alt_command='', priority=DEFAULT_PRIORITY, chance=1.0, action=None):
         self.description = str(description)
         self.command = command
         self.alt_command = alt_command
         self.priority = priority
+        self.chance = chance # how often it's offered at all
+        self.action = action # [name, argument] for act(), once it's chosen
 
     def set_priority(self, value):
         self.priority = value
 
     def __str__(self):
         return self.description
+
+    def to_list(self):
+        return [self.description, self.command, self.alt_command, self.priority, self.chance, self.action]
     
 options(
         human=Bunch(
@@ -71,23 +187,106 @@ options(
             )
         )
 
-last_order = get_setting('last_order')
-
 def set_order(o):
-    if str(o) == last_order: # this is what we had last time! keep it!
+    if str(o) == get_setting('last_order'): # this is what we had last time! keep it!
         options.human.order = o
     if o.priority > options.human.order.priority:
         options.human.order = o
 
+def offer(o):
+    """ set_order, if there is an order and it comes up this time """
+    if o is not None and random.random() <= o.chance:
+        set_order(o)
+
+def act(o):
+    """ Do whatever goes with an order once it's been chosen.  Sources
+    only describe this, since they may be cached or run out of time. """
+    if not o.action:
+        return
+    (name, arg) = o.action
+    if name == 'current':
+        t = todo.DefaultTodoList()
+        with t.transaction():
+            t.make_current(arg)
+    elif name == 'topmail': # for tm to open
+        topmail=file(os.path.expanduser('~/.topmail'),'w')
+        print >>topmail, arg
+        topmail.close()
+
+def gather_orders(sources, budget):
+    """ Run each (name, producer, deadline) source in its own thread and
+    return {name: order} for those that finished by their deadline and
+    the overall budget (in seconds).  Sources mustn't change anything
+    (see act), since one that runs late is left to finish unheeded. """
+    import threading, time, traceback
+    results = {}
+    def run(name, producer):
+        try:
+            results[name] = producer()
+        except Exception:
+            traceback.print_exc()
+    start = time.time()
+    threads = []
+    for (name, producer, deadline) in sources:
+        t = threading.Thread(target=run, args=(name, producer))
+        t.daemon = True # don't let a stuck source keep us from exiting
+        t.start()
+        threads.append((name, t, deadline))
+    for (name, t, deadline) in threads:
+        t.join(max(0, min(deadline, budget) - (time.time() - start)))
+        if t.is_alive():
+            print "Gave up waiting for", name
+    return dict(results)
+
+def stat_key(*paths):
+    """ Something that changes when any of these files or directories do """
+    key = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            key.append([st.st_mtime, st.st_size, st.st_ino])
+        except OSError:
+            key.append(None)
+    return key
+
+def cached_orders(sources, budget, refresh=False):
+    """ Orders from each (name, producer, deadline, ttl, key) source, in
+    order.  A source's last order is reused for ttl seconds as long as
+    key() gives the same answer; the rest are run with gather_orders. """
+    import time
+    cache = dict(get_setting('order_cache') or {})
+    results = {}
+    for (name, producer, deadline, ttl, key) in sources:
+        c = cache.get(name)
+        if refresh or not ttl or not c or time.time() - c['time'] > ttl:
+            continue
+        if c['key'] == key():
+            results[name] = c['order'] and Order(*c['order'])
+    stale = [s for s in sources if s[0] not in results]
+    produced = gather_orders([s[:3] for s in stale], budget)
+    for (name, producer, deadline, ttl, key) in stale:
+        if name not in produced:
+            continue
+        o = produced[name]
+        results[name] = o
+        if ttl:
+            # keyed after running, since producing may touch what it watches
+            cache[name] = {'time': time.time(), 'key': key(),
+                           'order': o and o.to_list()}
+    if stale:
+        store_setting_value('order_cache', cache)
+    return [results.get(s[0]) for s in sources]
+
+NOW_BUDGET = 3.0 # seconds
 
 @task
-@needs('bedtime')
-@needs('testtask')
-@needs('todolist')
-@needs('unreadmail')
 @needs('autocontext')
+@cmdopts([('refresh', 'r', "Ask every source again rather than use cached orders")])
 def now():
     """ Tell Danny what to do """
+    for o in cached_orders(order_sources, NOW_BUDGET, options.now.get('refresh')):
+        offer(o)
+    act(options.human.order)
     announce= todo.timestamp() + " " + str(options.human.order).lstrip()
     print(announce)
     store_setting('last_order', str(options.human.order))
@@ -99,68 +298,115 @@ def osd():
     this_order = get_setting('last_order')
     subprocess.call(["gtodo", this_order])   
 
+def test_order():
+    return Order('Test task',priority= MINIMUM_PRIORITY)
+
 @task
 def testtask():
-    set_order( Order('Test task',priority= MINIMUM_PRIORITY))
+    offer(test_order())
 
-@task
-def todolist():
-    """ Scan todo.txt """
+def todo_order():
     pr = DEFAULT_PRIORITY
     tags = get_tags()
-    t = todo.DefaultTodoList().top_todo(tags)
+    # our own list, as this may still be running after now has given up
+    t = todo.DefaultTodoList(shared=False).choose_todo(tags)
     if t == None:
-       return
+       return None
     if '@URGENT' in str(t):
         pr = TOP_PRIORITY
-    set_order(Order(t,'','todo_top_split', priority=pr))
+    return Order(t,'','todo_top_split', priority=pr, action=['current', str(t)])
+
+@task
+def todolist():
+    """ Scan todo.txt """
+    o = todo_order()
+    offer(o)
+    if o is options.human.order:
+        act(o)
+
+def todo_key():
+    f = os.path.expanduser('~/todo.txt')
+    return [stat_key(f, f + '.journal'), get_tags()]
 
 import re
-inbox = os.environ['MAILDIR']
-if not os.path.exists(inbox):
-    inbox = None
 
-@task
-def bedtime():
-    """ Stop myself working all night """
+def mail_inbox():
+    """ The Maildir in $MAILDIR, or None if there isn't one """
+    inbox = os.environ.get('MAILDIR')
+    if inbox and os.path.exists(inbox):
+        return inbox
+    return None
+
+def bedtime_order():
     n = datetime.datetime.now()
 
     if n.hour > 22 or n.hour < 8:
-        set_order(Order('Sleeeeeeeeeeeep is gooooooooooood', priority=TOP_PRIORITY))
+        return Order('Sleeeeeeeeeeeep is gooooooooooood', priority=TOP_PRIORITY)
+    return None
 
 @task
-def unreadmail():
-    """ Pluck out unread mail """
-    global inbox
-    if not inbox:
-        return
-    inbox="notmuch"
+def bedtime():
+    """ Stop myself working all night """
+    offer(bedtime_order())
+
+MAIL_QUERY = "tag:flagged OR (tag:inbox AND tag:recently AND NOT tag:archive AND NOT tag:lists)"
+
+def mail_backend():
+    """ notmuch if we have it, otherwise $MAILDIR searched directly """
+    import mailquery
+    backend = mailquery.NotmuchQuery()
+    if backend.available():
+        return backend
+    return mailquery.MaildirQuery(mail_inbox(), private_path('mail.index'))
+
+def mail_order():
+    if not mail_inbox():
+        return None
     inbox_zero_plus = 70
     inbox_zero_toomuch = 100
     inbox_chance = 0.2 # 1 in 5 tasks should be answering email
-    import mailbox
-    if inbox=="notmuch":
-        os.system('notmuch-mutt search "tag:flagged OR (tag:inbox AND tag:recently AND NOT tag:archive AND NOT tag:lists)" > /dev/null 2>&1')
-        inbox=os.path.expanduser("~/.cache/notmuch/mutt/results")
-    m = mailbox.Maildir(inbox)
-    if len(m) == 0:
-        return
-    if len(m) > inbox_zero_toomuch:
+    r = mail_backend().query(MAIL_QUERY)
+    count = r.count
+    if count == 0:
+        return None
+    if count > inbox_zero_toomuch:
         pr = TOP_PRIORITY
         inbox_chance = 0.5 # bring up the chances until we've dealt with backlog
-    elif len(m) > inbox_zero_plus:
+    elif count > inbox_zero_plus:
         pr = MEDIUM_PRIORITY
     else:
         pr = DEFAULT_PRIORITY
-    if (random.random() > inbox_chance):
-        return
-    mail_key = m.keys()[0]
-    mail = m[mail_key]
-    topmail=file(os.path.expanduser('~/.topmail'),'w')
-    message_id = mail['message-id']
+    mail = r.first
+    if mail is None:
+        return None # gone while we looked
+    message_id = mail['message-id'] or ''
     message_id = re.sub(r'[<>]','', message_id)
-    print >>topmail, message_id
-    set_order( Order('Deal with mail from %s about %s' % (mail['From'], mail['Subject']), 'tm', priority=pr) )
+    return Order('Deal with mail from %s about %s' % (mail['from'], mail['subject']), 'tm', priority=pr, chance=inbox_chance, action=['topmail', message_id])
+
+@task
+def unreadmail():
+    """ Pluck out unread mail """
+    o = mail_order()
+    offer(o)
+    if o is options.human.order:
+        act(o)
+
+def mail_key():
+    inbox = mail_inbox()
+    if not inbox:
+        return None
+    return stat_key(*[os.path.join(inbox, d) for d in ('new', 'cur', '.notmuch/xapian')])
+
+# What now asks for an order, in the order they're arbitrated, with how
+# many seconds each may take, how many seconds its answer can be reused
+# for (None for never) and what must stay the same for it to be reused.
+# autocontext runs before them all.
+order_sources = [
+    ('unreadmail', mail_order, 2.0, 300, mail_key),
+    ('todolist', todo_order, 3.0, 120, todo_key),
+    ('testtask', test_order, 1.0, None, None),
+    ('bedtime', bedtime_order, 1.0, None, None),
+    ]
 
 def get_tags():
     tags = get_setting('current_context')
@@ -188,7 +434,9 @@ def add():
     """ Add a new todo """
     newtodo = " ".join(options.args)
     t = todo.DefaultTodoList()
-    if t.add_new_todo(newtodo):
+    with t.transaction():
+        added = t.add_new_todo(newtodo)
+    if added:
         print "Added ", newtodo
     else:
         print "Could not add it!"
@@ -199,34 +447,36 @@ def split():
     """ Splits the current task into two """
     subtask = " ".join(options.args)
     tags = get_tags()
-    t =  todo.DefaultTodoList()
-    toptodo = t.top_todo(tags)
-    if not toptodo:
-        print "Don't know current task!"
-    print "Splitting ",toptodo
-    todo_tags = todo.Tag.extract_tags(str(toptodo)) 
-    if todo.Tag.current_tag() not in todo_tags: 
-        raise Exception, "Where is current tag?"
-        todo_tags += [todo.Tag.current_tag()]
-    subtask += ' ' + ' '.join(todo_tags)
-    subtask = '\t' * todo.indent_count(str(toptodo)) + subtask
-    toptodo.unset_current()
-    if todo.Tag.urgent_tag() in todo_tags:
-        visit_next = datetime.datetime.now() + datetime.timedelta(hours=2)
-    else:
-        visit_next = datetime.datetime.now() + datetime.timedelta(days=2)
-    try:
-        toptodo.add_tag(todo.Tag.ignore_tag(visit_next))
-    except todo.TodoError: # assume we can't add because there's already a ignore tag
-        toptodo.remove_tag(todo.Tag.ignore_tag(visit_next))
-        toptodo.add_tag(todo.Tag.ignore_tag(visit_next))
-    t.split_todo(toptodo, subtask)
+    t = todo.DefaultTodoList()
+    with t.transaction():
+        toptodo = t.top_todo(tags)
+        if not toptodo:
+            print "Don't know current task!"
+        print "Splitting ",toptodo
+        todo_tags = todo.Tag.extract_tags(str(toptodo)) 
+        if todo.Tag.current_tag() not in todo_tags: 
+            raise Exception, "Where is current tag?"
+            todo_tags += [todo.Tag.current_tag()]
+        subtask += ' ' + ' '.join(todo_tags)
+        subtask = '\t' * todo.indent_count(str(toptodo)) + subtask
+        toptodo.unset_current()
+        if todo.Tag.urgent_tag() in todo_tags:
+            visit_next = datetime.datetime.now() + datetime.timedelta(hours=2)
+        else:
+            visit_next = datetime.datetime.now() + datetime.timedelta(days=2)
+        try:
+            toptodo.add_tag(todo.Tag.ignore_tag(visit_next))
+        except todo.TodoError: # assume we can't add because there's already a ignore tag
+            toptodo.remove_tag(todo.Tag.ignore_tag(visit_next))
+            toptodo.add_tag(todo.Tag.ignore_tag(visit_next))
+        t.split_todo(toptodo, subtask)
 
 @task
 def done():
     """ Marks current task as done """
     t = todo.DefaultTodoList()
-    t.mark_current_done()
+    with t.transaction():
+        t.mark_current_done()
 
 @task
 @consume_args
@@ -234,17 +484,43 @@ def log():
     """ Timestamps and logs a task as done """
     tolog = " ".join(options.args)
     t = todo.DefaultTodoList()
-    t.timestamped_append_to_bottom(tolog)
+    with t.transaction():
+        t.timestamped_append_to_bottom(tolog)
     print "Logged!"
 
+@task
+@consume_args
+def archive():
+    """ Move done entries into the archive; 'archive gzip' compresses it """
+    t = todo.DefaultTodoList()
+    if t.archive is None:
+        t.archive = todo.TodoArchive(os.path.expanduser('~/todo.txt.archive'),
+                                     'gzip' in options.args)
+    with t.transaction():
+        n = t.archive_done()
+    print "Archived", n, "entries"
+
+@task
+@consume_args
+def history():
+    """ Print archived done entries between two dates, e.g. 2012-01 2012-03 """
+    t = todo.DefaultTodoList()
+    if t.archive is None:
+        return
+    args = options.args + [None, None]
+    for l in t.archive.entries(args[0], args[1]):
+        print l.strip()
+
 @task
 def autocontext():
     """ Automatically refresh tags """
     tags = get_tags()
-    ch = todo.ContextHandler(tags)
+    wifi = todo.CachedWifi(todo.IwgetidWifi(), private_path('wifi.cache'))
+    ch = todo.ContextHandler(tags, wifi)
     ch.refresh()
     new_tags = ch.get_tags()
     print "Changing tags from ", tags, " to ", new_tags
+    print "Time based tags next change at ", ch.next_change()
     set_tags(new_tags)
     
 
@@ -269,11 +545,42 @@ def listprojects():
     """ List all projects in todo list """
     print '\n'.join(filter_tags('PROJECT', todo.DefaultTodoList().get_all_tags() ))
 
+@task
+@consume_args
+def top():
+    """ List the best N todos for the current contexts """
+    if options.args:
+        n = int(options.args[0])
+    else:
+        n = 10
+    for (t, score) in todo.DefaultTodoList().ranked_todos(get_tags(), n):
+        print score, str(t).strip()
+
+@task
+def wakeups():
+    """ List the snoozed todos in the order they will come back """
+    for (when, t) in todo.DefaultTodoList().wakeups():
+        print when.strftime('%Y-%m-%d %H:%M'), str(t).strip()
+
+@task
+@consume_args
+def agenda():
+    """ List the repeating todos due in the next N days (default 7) """
+    if options.args:
+        days = int(options.args[0])
+    else:
+        days = 7
+    start = datetime.datetime.now()
+    end = start + datetime.timedelta(days=days)
+    for (when, t) in todo.DefaultTodoList().agenda(start, end):
+        print when.strftime('%Y-%m-%d %H:%M'), str(t).strip()
+
 @task
 def listtodos():
     z= todo.DefaultTodoList().get_all_todos()
+    tags = get_tags()
     for i in z:
-        print i, i.score(get_tags())
+        print i, i.score(tags)
     print
     print "Todos Total: ", len(z)
 